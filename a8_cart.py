@@ -16,12 +16,14 @@
 #	You should have received a copy of the GNU General Public License
 #	along with this program; if not, write to the Free Software
 #	Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
-from dataclasses import dataclass, field
+from collections import namedtuple
 from enum import IntEnum, unique, auto, IntFlag
+import io
+import mmap
+import os
 import struct
-import itertools as it
-
-from unicodedata import category
+import sys
+import time
 
 
 @unique
@@ -467,55 +469,217 @@ class ATCartridgeInfo(IntEnum):
     def _missing_(cls, value):
         if isinstance(value, str):
             try:
-                return cls(int(value, 0))
+                return find_mode(value)
             except ValueError:
-                # It was not an integer
-                return cls[value]
+                raise KeyError(value) from None
         return cls.Mode_Unknown
 
-@dataclass
+
+# Lookup indexes over ATCartridgeInfo, built once at import
+REAL_MODES: tuple[ATCartridgeInfo, ...] = tuple(sorted(mode for mode in ATCartridgeInfo if not mode.is_virtual))
+VIRTUAL_MODES: tuple[ATCartridgeInfo, ...] = tuple(sorted(mode for mode in ATCartridgeInfo if mode.is_virtual))
+_MODES_BY_SIZE: dict[int, tuple[ATCartridgeInfo, ...]] = {}
+_MODES_BY_SYSTEM: dict[SystemType, tuple[ATCartridgeInfo, ...]] = {}
+_MODES_BY_BANKING: dict[BankingType, tuple[ATCartridgeInfo, ...]] = {}
+# Names (including ATCartridgeMode aliases) and decimal mode numbers
+_MODES_BY_NAME: dict[str, ATCartridgeInfo] = {}
+
+
+def _build_mode_indexes():
+    # Group in definition order, so the first entry of a group is the first defined mode
+    for mode in ATCartridgeInfo:
+        if not mode.is_virtual:
+            _MODES_BY_SIZE[mode.mCartSize] = _MODES_BY_SIZE.get(mode.mCartSize, ()) + (mode,)
+            _MODES_BY_SYSTEM[mode.mSystemType] = _MODES_BY_SYSTEM.get(mode.mSystemType, ()) + (mode,)
+            _MODES_BY_BANKING[mode.mBankingType] = _MODES_BY_BANKING.get(mode.mBankingType, ()) + (mode,)
+    for name, mode in ATCartridgeInfo.__members__.items():
+        _MODES_BY_NAME[name] = mode
+        _MODES_BY_NAME[str(mode.value)] = mode
+    for name, mode in ATCartridgeMode.__members__.items():
+        _MODES_BY_NAME.setdefault(name, ATCartridgeInfo(mode.value))
+
+
+_build_mode_indexes()
+
+
+def modes_by_size(size: int) -> tuple[ATCartridgeInfo, ...]:
+    """Real cart modes with ROM size of exactly *size* bytes, in definition order"""
+    return _MODES_BY_SIZE.get(size, ())
+
+
+def modes_by_system(system: SystemType) -> tuple[ATCartridgeInfo, ...]:
+    """Real cart modes of *system* (800 or 5200), in definition order"""
+    return _MODES_BY_SYSTEM.get(system, ())
+
+
+def modes_by_banking(banking: BankingType) -> tuple[ATCartridgeInfo, ...]:
+    """Real cart modes using *banking* type, in definition order"""
+    return _MODES_BY_BANKING.get(banking, ())
+
+
+def find_mode(value) -> ATCartridgeInfo:
+    """Resolve a mode number, mode name or alias (e.g. 12, '0x0C', 'Mode_XEGS_32K') to ATCartridgeInfo.
+    Raises ValueError for unknown identifiers"""
+    if isinstance(value, str):
+        if (mode := _MODES_BY_NAME.get(value.strip())) is not None:
+            return mode
+        try:
+            # Other number formats Python recognizes: hexa, octal, binary, underscores
+            value = int(value, 0)
+        except ValueError:
+            raise ValueError(f'Unknown cart mode "{value}"') from None
+    if (mode := _MODES_BY_NAME.get(str(int(value)))) is not None:
+        return mode
+    raise ValueError(f'Unknown cart mode {value}')
+
+
+class ProfileCollector:
+    """Base of the profiling collectors attached with add_profile_collector. Spans nest, each span_start is followed by its span_end"""
+
+    def span_start(self, phase: str):
+        pass
+
+    def span_end(self, phase: str, elapsed: float):
+        pass
+
+
+_profile_collectors: list[ProfileCollector] = []
+
+
+def add_profile_collector(collector: ProfileCollector):
+    _profile_collectors.append(collector)
+
+
+def remove_profile_collector(collector: ProfileCollector):
+    _profile_collectors.remove(collector)
+
+
+class ProfileSpan:
+    """Context manager reporting the time spent in *phase* to the attached collectors. Without collectors it costs a list truth test"""
+    __slots__ = ('phase', '_start')
+
+    def __init__(self, phase: str):
+        self.phase = phase
+        self._start = None
+
+    def __enter__(self):
+        if _profile_collectors:
+            for collector in _profile_collectors:
+                collector.span_start(self.phase)
+            self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._start is not None:
+            elapsed = time.perf_counter() - self._start
+            for collector in reversed(_profile_collectors):
+                collector.span_end(self.phase, elapsed)
+
+
+# Size of the slices handed to the file object by the streaming writers
+WRITE_CHUNK_SIZE = 1 << 20
+
+
+def write_chunked(fobj, data, chunk_size: int = WRITE_CHUNK_SIZE) -> int:
+    """Write buffer-protocol object *data* to binary stream *fobj* in *chunk_size* slices without copying"""
+    written = 0
+    with memoryview(data).cast('B') as view:
+        for pos in range(0, len(view), chunk_size):
+            written += fobj.write(view[pos:pos + chunk_size]) or 0
+    return written
+
+
+def read_all(fobj) -> bytearray:
+    """Rest of binary stream *fobj* as bytearray. Files of known size are read straight into a buffer of that size, streams in chunks"""
+    try:
+        size = os.fstat(fobj.fileno()).st_size - fobj.tell()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        # Pipes and in-memory streams
+        size = 0
+    buffer = bytearray(max(size, 0))
+    pos = 0
+    with memoryview(buffer) as view:
+        while pos < len(view) and (read := fobj.readinto(view[pos:])):
+            pos += read
+    del buffer[pos:]
+    while chunk := fobj.read(WRITE_CHUNK_SIZE):
+        buffer += chunk
+    return buffer
+
+_numpy = None
+# Summing with NumPy pays off its import time above this size, or once it is imported anyway
+_NUMPY_SUM_MIN = 8 << 20
+
+
+def _get_numpy():
+    """NumPy module if installed, imported on first use only"""
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy
+
+
+def byte_sum(data) -> int:
+    """Sum of the bytes of bytes-like *data*, the CAR checksum before masking to 32 bits"""
+    np = _numpy if _numpy is not None or len(data) < _NUMPY_SUM_MIN else _get_numpy()
+    if np:
+        return int(np.frombuffer(data, dtype=np.uint8).sum(dtype=np.uint64))
+    return sum(data)
+
+
+def find_car_files(directory) -> list[str]:
+    """All .car files below *directory*, sorted"""
+    return sorted(os.path.join(dir_path, file_name) for dir_path, _, file_names in os.walk(directory) for file_name in file_names if file_name.lower().endswith('.car'))
+
+
+# Magic of the compressed container of a CAR file, see a8_cart_compress
+COMPRESSED_MAGIC = b'A8CZ'
+
+
 class A8CARFileHeader:
-    magic: bytes = field(default=b'CART')
-    _cart_mode: int = 0
-    csum: int = 0
-    blob_offset: int = 0
+    __slots__ = ('magic', '_cart_mode', 'csum', 'blob_offset')
+    _CART_HDR_STRUCT = '>4sLLL'
+    # magic, mode, checksum, BLOB offset
+    _HDR_STRUCT = struct.Struct(_CART_HDR_STRUCT)
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return (self.magic, self._cart_mode, self.csum, self.blob_offset) == (other.magic, other._cart_mode, other.csum, other.blob_offset)
+
+    def __repr__(self):
+        return f'{self.__class__.__qualname__}(magic={self.magic!r}, _cart_mode={self._cart_mode!r}, csum={self.csum!r}, blob_offset={self.blob_offset!r})'
 
     def read(self, max_bytes:int = 0):
         return self._as_bytes[:max_bytes] if max_bytes else self._as_bytes
 
     def __len__(self):
-        return struct.calcsize(self._CART_HDR_STRUCT)
+        return self._HDR_STRUCT.size
 
     def __init__(self, magic = None, typ: ATCartridgeInfo = 0, csum: int = 0, blob_offset: int = 0):
-        self._CART_HDR_STRUCT = '>4sLLL'
-        if magic == b'CART' or magic is None:
-            self.magic: bytes = magic or b'CART'
-            self._cart_mode: ATCartridgeInfo = ATCartridgeInfo(typ)
-            self.csum: int = csum
-            self.blob_offset: int = blob_offset
-        elif magic is not None:
-            if hasattr(magic, 'read'):
-                magic = magic.read(struct.calcsize(self._CART_HDR_STRUCT))
-                if isinstance(magic, bytes):
-                    self.__init__(magic=magic, typ=typ, csum=csum, blob_offset=blob_offset)
-                else:
-                    raise TypeError('Need binary stream')
-            elif isinstance(magic, str):
+        if magic is not None and magic != b'CART':
+            if isinstance(magic, str):
                 with open(magic, 'rb') as f_in:
-                    self.__init__(f_in, typ=typ, csum=csum, blob_offset=blob_offset)
-            elif isinstance(magic, bytes):
-                if len(magic) >= struct.calcsize(self._CART_HDR_STRUCT):
-                    magic, typ, csum, blob_offset = struct.unpack_from(self._CART_HDR_STRUCT, magic)
-                    if magic == b'CART':
-                        self.__init__(magic=magic, typ=typ, csum=csum, blob_offset=blob_offset)
-                    else:
-                        raise ValueError('Invalid input stream')
-                else:
-                    raise ValueError('Insufficient bytes for header')
-            else:
+                    magic = f_in.read(self._HDR_STRUCT.size)
+            elif hasattr(magic, 'read'):
+                magic = magic.read(self._HDR_STRUCT.size)
+                if not isinstance(magic, bytes):
+                    raise TypeError('Need binary stream')
+            elif not isinstance(magic, bytes):
                 raise TypeError(f'Can\'t init header with {type(magic)}')
-        else:
-            raise TypeError(f'Can\'t init header with {type(magic)}')
+            if len(magic) < self._HDR_STRUCT.size:
+                raise ValueError('Insufficient bytes for header')
+            magic, typ, csum, blob_offset = self._HDR_STRUCT.unpack_from(magic)
+            if magic != b'CART':
+                raise ValueError('Invalid input stream')
+        self.magic: bytes = b'CART'
+        self._cart_mode: ATCartridgeInfo = ATCartridgeInfo(typ)
+        self.csum: int = csum
+        self.blob_offset: int = blob_offset
 
     @property
     def cart_mode(self):
@@ -527,51 +691,231 @@ class A8CARFileHeader:
 
     @property
     def _as_bytes(self):
-        return struct.pack(self._CART_HDR_STRUCT, self.magic, self._cart_mode, self.csum, self.blob_offset)
+        return self._HDR_STRUCT.pack(self.magic, self._cart_mode, self.csum, self.blob_offset)
 
     def __iter__(self):
         return self._as_bytes.__iter__()
 
 
+# Bank *number* of a ROM: *offset* and *size* in the ROM image, CPU *window* and zero-copy memoryview *data*
+Bank = namedtuple('Bank', ('number', 'offset', 'size', 'window', 'data'))
+
+
 class A8CARFile:
     @property
     def data_csum(self):
-        return sum(self.rom_data) & 0xFFFFFFFF
+        if self._data_csum is None:
+            with ProfileSpan('csum'):
+                self._data_csum = byte_sum(self._rom_data) & 0xFFFFFFFF
+        return self._data_csum
+
+    @property
+    def rom_data(self):
+        return self._rom_data
+
+    @rom_data.setter
+    def rom_data(self, new_data):
+        self._rom_data = new_data
+        self._data_csum = None
+
+    def _adjust_csum(self, added=b'', removed=b'', added_sum: int = 0):
+        # Keep an already known checksum up to date, cost is proportional to the edited bytes only
+        if self._data_csum is not None:
+            self._data_csum = (self._data_csum + byte_sum(added) + added_sum - byte_sum(removed)) & 0xFFFFFFFF
+
+    def mutable_rom(self) -> bytearray:
+        """ROM as bytearray, edited in place by patch_rom, pad_rom and truncate_rom from then on. Other ROM types are copied once"""
+        if not isinstance(self._rom_data, bytearray):
+            self._rom_data = bytearray(self._rom_data)
+        return self._rom_data
+
+    def patch_rom(self, offset: int, data):
+        """Overwrite ROM bytes starting at *offset* with *data*. Writing past the end extends the ROM"""
+        if not 0 <= offset <= len(self._rom_data):
+            raise ValueError(f'Patch offset {offset} outside of ROM (size={len(self._rom_data)})')
+        data = bytes(data)
+        end = offset + len(data)
+        with memoryview(self._rom_data) as rom:
+            self._adjust_csum(added=data, removed=rom[offset:end])
+        self.mutable_rom()[offset:end] = data
+
+    def pad_rom(self, size: int, fill: int = 0xFF):
+        """Extend ROM to *size* bytes with *fill*. ROM is not modified if already big enough.
+        A bytearray ROM grows in place, any other ROM is copied once into a new bytearray of *size*"""
+        old_size = len(self._rom_data)
+        if size <= old_size:
+            return
+        self._adjust_csum(added_sum=fill * (size - old_size))
+        with memoryview(bytes((fill,)) * min(size - old_size, WRITE_CHUNK_SIZE)) as chunk:
+            if isinstance(self._rom_data, bytearray):
+                rom = self._rom_data
+                while len(rom) < size:
+                    rom += chunk[:size - len(rom)]
+            else:
+                # Zero filled by the allocation, only the old content is copied
+                rom = bytearray(size)
+                # Assigned through a memoryview, bytearray slice assignment would copy the source first
+                with memoryview(rom) as view:
+                    view[:old_size] = self._rom_data
+                    if fill:
+                        for pos in range(old_size, size, len(chunk)):
+                            view[pos:pos + len(chunk)] = chunk[:size - pos]
+                self._rom_data = rom
+
+    def truncate_rom(self, size: int):
+        """Cut ROM to *size* bytes. ROM is not modified if already small enough.
+        A bytearray ROM shrinks in place, any other ROM becomes a zero-copy memoryview slice"""
+        if 0 <= size < len(self._rom_data):
+            with memoryview(self._rom_data) as rom:
+                self._adjust_csum(removed=rom[size:])
+            if isinstance(self._rom_data, bytearray):
+                del self._rom_data[size:]
+            else:
+                self._rom_data = memoryview(self._rom_data)[:size]
+
+    def bank(self, number: int) -> Bank:
+        """Bank *number* of the ROM in the cart mode of the header, see get_bank. Release its data before closing a mapped file"""
+        return get_bank(self._rom_data, self._header.cart_mode, number)
+
+    def banks(self):
+        """Generate the banks of the ROM in the cart mode of the header, see iter_banks"""
+        return iter_banks(self._rom_data, self._header.cart_mode)
+
+    def resize_rom(self, size: int, fill: int = 0xFF):
+        """Truncate or extend (with *fill*) ROM to exactly *size* bytes"""
+        self.truncate_rom(size)
+        self.pad_rom(size, fill)
 
     @property
     def is_valid(self):
         return self._header == self.header
 
-    def __init__(self, fobj=None):
+    def __init__(self, fobj=None, mapped: bool = False, trust_csum: bool = False):
         self._header = A8CARFileHeader()
+        self._mmap = None
+        self._data_csum = None
         self.rom_data = bytes()
         self.blob = bytes()
         if fobj is not None:
             if hasattr(fobj, 'read'):
-                self._header = A8CARFileHeader(fobj)
-                if self._header.blob_offset:
-                    self.rom_data = fobj.read(self._header.blob_offset - len(self._header))
-                    self.blob = fobj.read()
-                else:
-                    self.rom_data = fobj.read()
+                with ProfileSpan('map' if mapped else 'read'):
+                    if not (mapped and self._map(fobj)):
+                        head = fobj.read(len(self._header))
+                        if not isinstance(head, bytes):
+                            raise TypeError('Need binary stream')
+                        if head[:4] == COMPRESSED_MAGIC:
+                            import a8_cart_compress
+                            self._header, self.rom_data, self.blob = a8_cart_compress.load(fobj, head)
+                        else:
+                            self._header = A8CARFileHeader(head)
+                            if self._header.blob_offset:
+                                self.rom_data = fobj.read(self._header.blob_offset - len(self._header))
+                                self.blob = fobj.read()
+                            else:
+                                self.rom_data = fobj.read()
             else:
-                with open(fobj, 'rb') as f_in:
-                    self.__init__(f_in)
+                with open_input(fobj) as f_in:
+                    self.__init__(f_in, mapped=mapped, trust_csum=trust_csum)
+                return
+            if trust_csum:
+                # Take the stored checksum as a starting point instead of summing the whole ROM
+                self._data_csum = self._header.csum
+
+    def _map(self, fobj) -> bool:
+        """Back ROM and BLOB with read-only memoryview slices of a mmap of *fobj*. Returns False if *fobj* can't be mapped"""
+        try:
+            mapping = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+            # Pipes, in-memory streams and empty files are read the classic way
+            return False
+        if mapping[:4] == COMPRESSED_MAGIC:
+            # Decompressed into memory instead
+            mapping.close()
+            return False
+        self._mmap = mapping
+        try:
+            self._header = A8CARFileHeader(mapping[:len(self._header)])
+        except Exception:
+            # Not a CAR file, don't leave the mapping behind
+            self._mmap = None
+            mapping.close()
+            raise
+        self._set_sections(memoryview(mapping))
+        return True
+
+    def _set_sections(self, view: memoryview):
+        # ROM and BLOB as slices of *view* of the whole file, split as the header says
+        if self._header.blob_offset:
+            self.rom_data = view[len(self._header):self._header.blob_offset]
+            self.blob = view[self._header.blob_offset:]
+        else:
+            self.rom_data = view[len(self._header):]
+
+    @classmethod
+    def from_buffer(cls, buffer, trust_csum: bool = False):
+        """CAR file parsed from bytes-like *buffer* without copying, ROM and BLOB are memoryview slices of it"""
+        view = memoryview(buffer).cast('B')
+        if view[:4] == COMPRESSED_MAGIC:
+            return cls(io.BytesIO(view), trust_csum=trust_csum)
+        cart = cls()
+        cart._header = A8CARFileHeader(bytes(view[:len(cart._header)]))
+        cart._set_sections(view)
+        if trust_csum:
+            cart._data_csum = cart._header.csum
+        return cart
+
+    @property
+    def is_mapped(self) -> bool:
+        return self._mmap is not None
+
+    def close(self):
+        """Release the memory mapping of a mapped CAR file. ROM and BLOB are no longer accessible afterwards"""
+        if self._mmap is not None:
+            for section in (self.rom_data, self.blob):
+                if isinstance(section, memoryview):
+                    section.release()
+            self.rom_data = bytes()
+            self.blob = bytes()
+            self._mmap.close()
+            self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
     def __len__(self):
         return sum(map(len, (self.header, self.rom_data, self.blob)))
 
     @property
     def _as_bytes(self):
-        return it.chain(self.header, self.rom_data, self.blob)
+        return bytes(self)
+
+    def __bytes__(self):
+        header = self.header._as_bytes
+        with ProfileSpan('serialize'):
+            return b''.join((header, self.rom_data, self.blob))
+
+    def write_to(self, fobj, chunk_size: int = WRITE_CHUNK_SIZE) -> int:
+        """Stream packed header, ROM and BLOB to binary stream *fobj*, returns number of bytes written"""
+        header = self.header._as_bytes
+        with ProfileSpan('write'):
+            written = fobj.write(header) or 0
+            for section in (self.rom_data, self.blob):
+                if section:
+                    written += write_chunked(fobj, section, chunk_size)
+        return written
 
     @property
     def header(self):
-        new_hdr = A8CARFileHeader()
-        new_hdr._cart_mode = ATCartridgeInfo(self._header._cart_mode)
-        new_hdr.csum = self.data_csum
-        new_hdr.blob_offset = len(new_hdr) + len(self.rom_data) if self.blob else 0
-        self._header = new_hdr
+        csum = self.data_csum
+        with ProfileSpan('header'):
+            new_hdr = A8CARFileHeader()
+            new_hdr._cart_mode = ATCartridgeInfo(self._header._cart_mode)
+            new_hdr.csum = csum
+            new_hdr.blob_offset = len(new_hdr) + len(self.rom_data) if self.blob else 0
+            self._header = new_hdr
         return self._header
 
     def __iter__(self):
@@ -580,6 +924,509 @@ class A8CARFile:
     def read(self, max_bytes:int = 0):
         return self._as_bytes[:max_bytes] if max_bytes else self._as_bytes
 
+
+# Header fields as read from disk, *mode* is the raw mode number (ATCartridgeInfo(record.mode) when needed)
+HeaderRecord = namedtuple('HeaderRecord', ('path', 'mode', 'csum', 'blob_offset', 'file_size'))
+
+_SCAN_BATCH = 1024
+
+
+def unpack_headers(buffer) -> list[tuple]:
+    """(magic, mode, csum, blob_offset) of each of the headers packed back to back in bytes-like *buffer*"""
+    return list(A8CARFileHeader._HDR_STRUCT.iter_unpack(buffer))
+
+
+def _header_records(files, raw):
+    return [HeaderRecord(path, mode, csum, blob_offset, file_size) for (path, file_size), (_, mode, csum, blob_offset) in zip(files, unpack_headers(raw))]
+
+
+def scan_headers(paths):
+    """Generate a HeaderRecord of each of *paths* that starts with a CAR header, reading 16 bytes per file.
+    Files that are too short, lack the CART magic or can't be opened are skipped"""
+    size = A8CARFileHeader._HDR_STRUCT.size
+    files = []
+    raw = bytearray()
+    for path in paths:
+        try:
+            with open(path, 'rb', buffering=0) as f_in:
+                data = f_in.read(size)
+                file_size = os.fstat(f_in.fileno()).st_size
+        except OSError:
+            continue
+        if len(data) == size and data[:4] == b'CART':
+            files.append((path, file_size))
+            raw += data
+            if len(files) == _SCAN_BATCH:
+                # The headers of a batch are unpacked in one go
+                yield from _header_records(files, raw)
+                files.clear()
+                raw.clear()
+    yield from _header_records(files, raw)
+
+
+def verify_file(file_name, checksum: bool = True, chunk_size: int = WRITE_CHUNK_SIZE) -> list[str]:
+    """Problems found in CAR file *file_name*, empty if it is sound. Checks magic, cart mode, BLOB offset and ROM size against the mode,
+    and with *checksum* the ROM sum against the header, reading the ROM in *chunk_size* pieces into one reused buffer.
+    Compressed containers are checked by a8_cart_compress.verify"""
+    with open(file_name, 'rb') as f_in:
+        file_size = os.fstat(f_in.fileno()).st_size
+        raw = f_in.read(len(A8CARFileHeader()))
+        if raw[:4] == COMPRESSED_MAGIC:
+            import a8_cart_compress
+            return a8_cart_compress.verify(f_in, checksum=checksum)
+        if len(raw) < len(A8CARFileHeader()):
+            return [f'File too short for a header ({file_size} bytes)']
+        if raw[:4] != b'CART':
+            return [f'Bad magic {raw[:4]!r}']
+        problems = []
+        header = A8CARFileHeader(raw)
+        mode = header.cart_mode
+        csum = header.csum
+        blob_offset = header.blob_offset
+        if mode.is_virtual:
+            problems.append(f'Unknown cart mode {int.from_bytes(raw[4:8], "big")}')
+        if blob_offset and not len(raw) <= blob_offset <= file_size:
+            problems.append(f'BLOB offset {blob_offset:_} outside of the file ({file_size:_} bytes)')
+            blob_offset = 0
+        rom_size = (blob_offset or file_size) - len(raw)
+        if not mode.is_virtual and rom_size != mode.mCartSize:
+            problems.append(f'ROM size {rom_size:_} differs from {mode.name} size {mode.mCartSize:_}')
+        if checksum:
+            buffer = bytearray(min(chunk_size, rom_size))
+            total = 0
+            with memoryview(buffer) as view:
+                remaining = rom_size
+                while remaining:
+                    read = f_in.readinto(view[:min(remaining, len(view))])
+                    if not read:
+                        break
+                    total += byte_sum(view[:read])
+                    remaining -= read
+            if total & 0xFFFFFFFF != csum:
+                problems.append(f'Checksum mismatch: header 0x{csum:08X}, ROM 0x{total & 0xFFFFFFFF:08X}')
+    return problems
+
+
+# File name standing for standard input or output
+STDIO = '-'
+# Output spooled for a pipe stays in memory up to this size, then goes to a temporary file
+SPOOL_MAX_SIZE = 64 << 20
+# Read once here, os.umask() can only be queried by setting it, which would race with threads creating files
+_UMASK = os.umask(0o022)
+os.umask(_UMASK)
+
+
+def open_input(file_name):
+    """Binary stream of *file_name* for a with block, standard input (left open) for STDIO"""
+    if file_name == STDIO:
+        import contextlib
+        return contextlib.nullcontext(sys.stdin.buffer)
+    return open(file_name, 'rb')
+
+
+def open_output(file_name):
+    """Binary stream writing *file_name* for a with block, standard output (left open) for STDIO"""
+    if file_name == STDIO:
+        import contextlib
+        return contextlib.nullcontext(sys.stdout.buffer)
+    return open(file_name, 'wb')
+
+
+class AtomicWriter:
+    """Context manager giving a binary file that replaces *file_name* only once it is completely written.
+    Data goes to a temporary file next to *file_name*, which is renamed over *file_name* when the block exits without error.
+    STDIO as *file_name* writes standard output directly. With *spool*, for writers that seek back or verify before publishing,
+    output to a pipe is kept in a temporary spool and copied out only once complete.
+    With *sync* False the data is not flushed to disk before the rename, for callers syncing many files at once"""
+
+    def __init__(self, file_name, spool: bool = False, sync: bool = True):
+        self.file_name = os.fspath(file_name)
+        self.spool = spool
+        self.sync = sync
+        self._tmp_name = None
+        self._file = None
+        self._stdout = None
+
+    def __enter__(self):
+        import tempfile
+        if self.file_name == STDIO:
+            self._stdout = sys.stdout.buffer
+            sys.stdout.flush()
+            if not self.spool or (self._stdout.seekable() and self._stdout.tell() == 0):
+                # Standard output redirected to a file is as good as the file itself
+                self._file = self._stdout
+            else:
+                self._file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+            return self._file
+        fd, self._tmp_name = tempfile.mkstemp(dir=os.path.dirname(self.file_name) or '.', prefix=f'.{os.path.basename(self.file_name)}.', suffix='.tmp')
+        self._file = os.fdopen(fd, 'wb')
+        return self._file
+
+    def _exit_stdout(self, exc_type):
+        import shutil
+        if self._file is self._stdout:
+            if self._stdout.seekable():
+                # Writers seeking back leave the position behind the end
+                self._stdout.seek(0, os.SEEK_END)
+        else:
+            with self._file:
+                if exc_type is None:
+                    self._file.seek(0)
+                    shutil.copyfileobj(self._file, self._stdout, WRITE_CHUNK_SIZE)
+        self._stdout.flush()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        import shutil
+        if self._stdout is not None:
+            self._exit_stdout(exc_type)
+            return
+        try:
+            if exc_type is None and self.sync:
+                with ProfileSpan('sync'):
+                    self._file.flush()
+                    os.fsync(self._file.fileno())
+            self._file.close()
+            if exc_type is None:
+                if os.path.exists(self.file_name):
+                    shutil.copymode(self.file_name, self._tmp_name)
+                else:
+                    # mkstemp creates owner-only files, give new files the usual umask based permissions
+                    os.chmod(self._tmp_name, 0o666 & ~_UMASK)
+                os.replace(self._tmp_name, self.file_name)
+                return
+        except BaseException:
+            os.unlink(self._tmp_name)
+            raise
+        os.unlink(self._tmp_name)
+
+
+def save_atomic(cart: A8CARFile, file_name) -> int:
+    """Write *cart* to a temporary file next to *file_name* and rename it over *file_name* once complete.
+    A crash mid-write leaves the original file untouched. A mapped *cart* is closed before the rename,
+    as the open mapping would pin the original file on some platforms."""
+    with AtomicWriter(file_name) as f_out:
+        written = cart.write_to(f_out)
+        cart.close()
+    return written
+
+
+def _write_blob(f_out, header: A8CARFileHeader, rom_end: int, blob):
+    # BLOB goes to *rom_end* of *f_out*, the blob offset of *header* is set accordingly
+    import shutil
+    f_out.seek(rom_end)
+    if hasattr(blob, 'read'):
+        shutil.copyfileobj(blob, f_out, WRITE_CHUNK_SIZE)
+    elif blob:
+        write_chunked(f_out, blob)
+    header.blob_offset = rom_end if f_out.tell() > rom_end else 0
+
+
+def update_in_place(file_name, cart_mode=None, blob=None) -> A8CARFileHeader:
+    """Patch the header and BLOB of CAR *file_name* without rewriting the ROM.
+    *cart_mode* replaces the cart type when given. *blob* (bytes-like or binary stream) replaces the BLOB when given,
+    an empty *blob* removes it. ROM and its checksum are left untouched. Returns the header written.
+    Replacing an existing BLOB rewrites the file atomically, as the header points at the old BLOB while it is overwritten"""
+    with ProfileSpan('update_in_place'), open(file_name, 'r+b') as f_car:
+        header = A8CARFileHeader(f_car)
+        if cart_mode is not None:
+            header.cart_mode = cart_mode
+        if blob is not None and header.blob_offset and (hasattr(blob, 'read') or len(blob)):
+            rom_end = header.blob_offset
+            with AtomicWriter(file_name) as f_out:
+                f_car.seek(len(header))
+                f_out.seek(len(header))
+                remaining = rom_end - len(header)
+                while remaining > 0 and (chunk := f_car.read(min(remaining, WRITE_CHUNK_SIZE))):
+                    remaining -= f_out.write(chunk)
+                _write_blob(f_out, header, rom_end, blob)
+                f_out.seek(0)
+                f_out.write(header._as_bytes)
+            return header
+        if blob is not None:
+            # Adding a BLOB or removing one: the header points at it only once the new content is complete
+            _write_blob(f_car, header, header.blob_offset or f_car.seek(0, os.SEEK_END), blob)
+            f_car.truncate()
+            # BLOB must be on disk before the header starts pointing to it
+            f_car.flush()
+            os.fsync(f_car.fileno())
+        f_car.seek(0)
+        f_car.write(header._as_bytes)
+    return header
+
+
+# Asyncio API. File I/O runs in WRITE_CHUNK_SIZE chunks on a bounded thread pool, so the event loop is never blocked,
+# and a cancelled load or save stops at the next chunk. asyncio and the pool are set up on first use only.
+ASYNC_MAX_WORKERS = 8
+ASYNC_CONCURRENCY = 16
+_async_executor = None
+_async_limit = (None, None)  # (event loop, semaphore limiting the files in progress on that loop)
+
+
+def configure_async(max_workers: int = ASYNC_MAX_WORKERS, concurrency: int = ASYNC_CONCURRENCY):
+    """Set the number of I/O threads and the number of files load/save/read_header process at once"""
+    global ASYNC_MAX_WORKERS, ASYNC_CONCURRENCY, _async_executor, _async_limit
+    ASYNC_MAX_WORKERS = max_workers
+    ASYNC_CONCURRENCY = concurrency
+    if _async_executor is not None:
+        _async_executor.shutdown(wait=False)
+    _async_executor = None
+    _async_limit = (None, None)
+
+
+def _async_slot():
+    import asyncio
+    global _async_limit
+    loop = asyncio.get_running_loop()
+    if _async_limit[0] is not loop:
+        _async_limit = (loop, asyncio.Semaphore(ASYNC_CONCURRENCY))
+    return _async_limit[1]
+
+
+async def _in_thread(func, *args):
+    """Run *func* on the I/O thread pool. On cancellation the running call is still awaited, so the caller can clean up its file safely"""
+    import asyncio
+    global _async_executor
+    if _async_executor is None:
+        import concurrent.futures
+        _async_executor = concurrent.futures.ThreadPoolExecutor(max_workers=ASYNC_MAX_WORKERS, thread_name_prefix='a8_cart_io')
+    future = asyncio.get_running_loop().run_in_executor(_async_executor, func, *args)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await asyncio.wait((future,))
+        raise
+
+
+async def read_header(file_name) -> A8CARFileHeader:
+    """Read the header of CAR file *file_name* without blocking the event loop"""
+    async with _async_slot():
+        return await _in_thread(A8CARFileHeader, os.fspath(file_name))
+
+
+async def load(file_name, trust_csum: bool = False) -> A8CARFile:
+    """Load CAR file *file_name* without blocking the event loop. The file is read in chunks, cancellation takes effect between them"""
+    async with _async_slot():
+        f_in = await _in_thread(open, file_name, 'rb')
+        try:
+            data = bytearray(os.fstat(f_in.fileno()).st_size)
+            with memoryview(data) as view:
+                pos = 0
+                while pos < len(data):
+                    read = await _in_thread(f_in.readinto, view[pos:pos + WRITE_CHUNK_SIZE])
+                    if not read:
+                        # File got shorter since it was opened
+                        break
+                    pos += read
+        finally:
+            f_in.close()
+        return await _in_thread(A8CARFile.from_buffer, memoryview(data)[:pos], trust_csum)
+
+
+async def save(cart: A8CARFile, file_name) -> int:
+    """Write *cart* to *file_name* like save_atomic, without blocking the event loop.
+    On cancellation or error the temporary file is removed and *file_name* stays untouched, unless the final rename was already under way"""
+    async with _async_slot():
+        writer = AtomicWriter(file_name)
+        try:
+            # A cancelled __enter__ has still run to its end, the temporary file is removed below
+            f_out = await _in_thread(writer.__enter__)
+            # The header needs the ROM checksum, which takes a while for big ROMs
+            written = await _in_thread(f_out.write, await _in_thread(lambda: cart.header._as_bytes))
+            for section in (cart.rom_data, cart.blob):
+                with memoryview(section).cast('B') as view:
+                    for pos in range(0, len(view), WRITE_CHUNK_SIZE):
+                        written += await _in_thread(f_out.write, view[pos:pos + WRITE_CHUNK_SIZE])
+            cart.close()
+        except BaseException as e:
+            if writer._file is not None:
+                await _in_thread(writer.__exit__, type(e), e, e.__traceback__)
+            raise
+        await _in_thread(writer.__exit__, None, None, None)
+    return written
+
+
+# Cart modes preferred by autodetection when content based scores are equal
+PREFERRED_CART_MODES = (
+    ATCartridgeInfo.Mode_8K, ATCartridgeInfo.Mode_16K,
+    ATCartridgeInfo.Mode_XEGS_32K, ATCartridgeInfo.Mode_XEGS_64K, ATCartridgeInfo.Mode_XEGS_128K,
+    ATCartridgeInfo.Mode_XEGS_256K, ATCartridgeInfo.Mode_XEGS_512K, ATCartridgeInfo.Mode_XEGS_1M,
+)
+
+# CPU address window [start, end) of the init/run vectors for each init range
+_INIT_WINDOWS = {
+    InitRange.kInit2K: (0xB800, 0xC000),
+    InitRange.kInit4K: (0xB000, 0xC000),
+    InitRange.kInit8K: (0xA000, 0xC000),
+    InitRange.kInit8KR: (0x8000, 0xA000),
+    InitRange.kInit16K: (0x8000, 0xC000),
+    InitRange.kInit32K: (0x4000, 0xC000),
+}
+
+
+def bank_size(mode: ATCartridgeInfo) -> int:
+    """Size of the ROM slices *mode* switches into its CPU window. Modes without banking are a single bank of the whole cart"""
+    mode = ATCartridgeInfo(mode)
+    if mode.mBankingType == BankingType.kBankNone:
+        return mode.mCartSize
+    start, end = _INIT_WINDOWS[mode.mInitRange]
+    return min(end - start, mode.mCartSize)
+
+
+def bank_window(mode: ATCartridgeInfo) -> tuple[int, int]:
+    """CPU address range [start, end) a bank of *mode* is visible in, ending where the init window of the mode ends"""
+    mode = ATCartridgeInfo(mode)
+    start, end = _INIT_WINDOWS[mode.mInitRange]
+    size = bank_size(mode)
+    return (max(start, end - size), end) if size else (start, end)
+
+
+def get_bank(rom, mode: ATCartridgeInfo, number: int) -> Bank:
+    """Bank *number* of *rom* in cart *mode*, viewed without copying. Negative numbers count from the last bank"""
+    size = bank_size(mode) or len(rom) or 1
+    count = -(-len(rom) // size)
+    if not -count <= number < count:
+        raise IndexError(f'No bank {number}, ROM of {len(rom):_} bytes has {count} banks of {size:_}')
+    number %= count
+    with memoryview(rom) as view:
+        data = view.cast('B')[number * size:(number + 1) * size]
+    return Bank(number, number * size, len(data), bank_window(mode), data)
+
+
+def iter_banks(rom, mode: ATCartridgeInfo):
+    """Generate the banks of *rom* in cart *mode* one by one, each viewed only once asked for"""
+    size = bank_size(mode) or len(rom) or 1
+    for number in range(-(-len(rom) // size)):
+        yield get_bank(rom, mode, number)
+
+
+def split_banks(rom, mode: ATCartridgeInfo) -> list[memoryview]:
+    """Zero-copy slices of *rom* per bank of *mode*. A ROM not filling its last bank ends with a short slice"""
+    view = memoryview(rom).cast('B')
+    size = bank_size(mode) or len(view) or 1
+    return [view[pos:pos + size] for pos in range(0, len(view), size)]
+
+
+# Size of the 6 byte cartridge trailer ($xFFA-$xFFF) found at the end of the boot window
+_TRAILER_SIZE = 6
+# 5200 carts end with a 20 character title ($BFE8-$BFFB) before the year and start vector
+_5200_TRAILER_SIZE = 24
+_PROBE_SIZE = max(_TRAILER_SIZE, _5200_TRAILER_SIZE)
+# ANTIC internal codes (color bits stripped) expected in a 5200 title: space, '-', '.', digits and letters
+_5200_TITLE_CHARS = frozenset((0x00, 0x0D, 0x0E, *range(0x10, 0x1A), *range(0x21, 0x3B)))
+
+
+# Precomputed probe offsets of a cart mode. Offsets point right after a trailer in the ROM image
+DetectPlan = namedtuple('DetectPlan', ('mode', 'boot_end', 'bank_ends', 'window'))
+DetectCandidate = namedtuple('DetectCandidate', ('mode', 'confidence'))
+
+
+_detect_plans_by_size: dict[int, tuple[DetectPlan, ...]] = {}
+
+
+def _make_detect_plan(mode: ATCartridgeInfo) -> DetectPlan:
+    size = mode.mCartSize
+    header_type = mode.mHeaderType
+    boot_end = {
+        HeaderType.kHeaderFirst4K: 0x1000,
+        HeaderType.kHeaderFirst8K: 0x2000,
+        HeaderType.kHeaderFirst8K_PreferAll8K: 0x2000,
+        HeaderType.kHeaderFirst16K: 0x4000,
+        HeaderType.kHeaderFirst16K_PreferAll16K: 0x4000,
+        HeaderType.kHeaderFirst32K: 0x8000,
+    }.get(header_type, size)
+    bank_size = {
+        HeaderType.kHeaderFirst8K_PreferAll8K: 0x2000,
+        HeaderType.kHeaderLast8K_PreferAll8K: 0x2000,
+        HeaderType.kHeaderFirst16K_PreferAll16K: 0x4000,
+    }.get(header_type)
+    bank_ends = tuple(range(bank_size, size + 1, bank_size)) if bank_size else ()
+    return DetectPlan(mode, min(boot_end, size), bank_ends, _INIT_WINDOWS[mode.mInitRange])
+
+
+def detect_plans(size: int) -> tuple[DetectPlan, ...]:
+    """Probe plans of all real cart modes of exactly *size* bytes, built once per size"""
+    if (plans := _detect_plans_by_size.get(size)) is None:
+        plans = tuple(_make_detect_plan(mode) for mode in modes_by_size(size))
+        _detect_plans_by_size[size] = plans
+    return plans
+
+
+def _score_trailer(trailer: bytes, window: tuple, system: SystemType) -> float:
+    lo, hi = window
+    if system == SystemType.kType5200:
+        if len(trailer) < _5200_TRAILER_SIZE:
+            return 0.0
+        # $BFE8-$BFFB: title, $BFFC-$BFFD: copyright year digits or $FF at $BFFD (skip logo), $BFFE-$BFFF: start vector
+        title = trailer[-_5200_TRAILER_SIZE:-4]
+        year_hi, year_lo, start = struct.unpack_from('<BBH', trailer, len(trailer) - 4)
+        if not lo <= start < hi:
+            return 0.0
+        if year_lo == 0xFF:
+            # No title shown, nothing else to check
+            return 0.8
+        # Any start vector in the window is a coin toss for random data, the title and the year have to look real too
+        if not all(0x10 <= digit & 0x3F <= 0x19 for digit in (year_hi, year_lo)):
+            return 0.0
+        if sum(char & 0x3F in _5200_TITLE_CHARS for char in title) < len(title) * 3 // 4:
+            return 0.0
+        return 1.0
+    if len(trailer) < _TRAILER_SIZE:
+        return 0.0
+    # $xFFA-$xFFB: run vector, $xFFC: cart present (0), $xFFD: option flags, $xFFE-$xFFF: init vector
+    run, present, options, init = struct.unpack('<HBBH', trailer[-_TRAILER_SIZE:])
+    if present != 0:
+        return 0.0
+    return 0.4 + (0.3 if lo <= init < hi else 0.0) + (0.3 if lo <= run < hi or not options & 0x04 else 0.0)
+
+
+def detect_cart_modes(rom, prefer=PREFERRED_CART_MODES) -> list[DetectCandidate]:
+    """Rank all cart modes matching the size of *rom* by inspecting the cartridge trailers their header type describes.
+    *rom* is a bytes-like object or a seekable binary stream positioned anywhere; only the trailer bytes are read.
+    Returns candidates with confidence in range 0..1, best first. Equal scores are ordered by *prefer*."""
+    with ProfileSpan('detect'):
+        return _detect_cart_modes(rom, prefer)
+
+
+def _detect_cart_modes(rom, prefer) -> list[DetectCandidate]:
+    if hasattr(rom, 'read'):
+        base = rom.tell()
+        size = rom.seek(0, os.SEEK_END) - base
+
+        def read_trailer(end):
+            rom.seek(base + end - _PROBE_SIZE)
+            return rom.read(_PROBE_SIZE)
+    else:
+        size = len(rom)
+
+        def read_trailer(end):
+            return bytes(rom[end - _PROBE_SIZE:end])
+
+    plans = detect_plans(size)
+    trailers = {}
+    for end in sorted({end for plan in plans for end in (plan.boot_end, *plan.bank_ends)}):
+        trailers[end] = read_trailer(end) if end >= _PROBE_SIZE else b''
+    if hasattr(rom, 'read'):
+        rom.seek(base)
+
+    prefer = tuple(prefer)
+    candidates = []
+    for order, plan in enumerate(plans):
+        system = plan.mode.mSystemType
+        boot_score = _score_trailer(trailers[plan.boot_end], plan.window, system)
+        if plan.bank_ends:
+            bank_score = sum(_score_trailer(trailers[end], plan.window, system) >= 0.7 for end in plan.bank_ends) / len(plan.bank_ends)
+        else:
+            bank_score = boot_score
+        confidence = 0.75 * boot_score + 0.15 * bank_score
+        if plan.mode in prefer:
+            confidence += 0.1
+        if plan.mode.mFlags == ATCartDetectFlags.DontRecommend:
+            confidence -= 0.1
+        rank = prefer.index(plan.mode) if plan.mode in prefer else len(prefer)
+        candidates.append((-round(min(max(confidence, 0.0), 1.0), 6), rank, order, plan.mode))
+    return [DetectCandidate(mode, -confidence) for confidence, _, _, mode in sorted(candidates)]
+
+
 try:
     # If running from MALCAT, execute the block
     from filetypes.base import *
@@ -0,0 +1,270 @@
+# Compressed CAR container.
+# Large cart images are mostly padding, so the ROM is stored as independently compressed frames of whole banks (64K at least),
+# followed by the BLOB as one more frame. Identical frames (0xFF padding, mirrored banks) are stored once.
+# The frame index follows the fixed header, so a bank is decompressed on demand by reading just its frame.
+# Layout, big-endian like the CAR header:
+#   magic 'A8CZ', version, codec, frame size, number of ROM and BLOB frames, CAR header as stored in the original file
+#   per frame: data offset (from the end of the index), compressed size, raw size, CRC-32 of the raw data
+#   frame data
+import os
+import struct
+import zlib
+
+import a8_cart
+from a8_cart import A8CARFile, A8CARFileHeader
+
+COMPRESSED_MAGIC = a8_cart.COMPRESSED_MAGIC
+CONTAINER_VERSION = 1
+_CONTAINER_HDR_STRUCT = struct.Struct('>4sBBxxLLL16s')
+_FRAME_STRUCT = struct.Struct('>QLLL')
+
+MIN_FRAME_SIZE = 0x10000
+DEFAULT_CODEC = 'zlib'
+
+
+def _lzma():
+    import lzma
+    return lzma
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError('zstd codec needs the zstandard package (pip install zstandard)') from None
+    return zstandard
+
+
+# name: (id, compress(data, level), decompress(data, raw size))
+CODECS = {
+    'none': (0, lambda data, level: bytes(data), lambda data, size: data),
+    'zlib': (1, lambda data, level: zlib.compress(data, 9 if level is None else level), lambda data, size: zlib.decompress(data, bufsize=size)),
+    'lzma': (2, lambda data, level: _lzma().compress(data, preset=6 if level is None else level), lambda data, size: _lzma().decompress(data)),
+    'zstd': (3, lambda data, level: _zstd().ZstdCompressor(level=19 if level is None else level).compress(data),
+             lambda data, size: _zstd().ZstdDecompressor().decompress(data, max_output_size=size)),
+}
+_CODEC_NAMES = {codec_id: name for name, (codec_id, _, _) in CODECS.items()}
+
+
+def frame_size(mode) -> int:
+    """Raw size of the ROM frames of cart *mode*: a whole number of banks, at least MIN_FRAME_SIZE unless banks are bigger"""
+    bank = a8_cart.bank_size(mode) or MIN_FRAME_SIZE
+    return bank * max(1, MIN_FRAME_SIZE // bank)
+
+
+def _frames(data, size: int):
+    with memoryview(data) as view:
+        for pos in range(0, len(view), size):
+            # Released right away, a mapped file can't be closed while any slice is alive
+            with view[pos:pos + size] as frame:
+                yield frame
+
+
+def compress(cart_file, out_file, codec: str = DEFAULT_CODEC, level: int = None) -> dict:
+    """Write CAR file *cart_file* as compressed container *out_file* using *codec* (see CODECS) at *level* (codec default if None).
+    Returns the sizes and the number of frames, stored and total"""
+    import hashlib
+    codec_id, compress_frame, _ = CODECS[codec]
+    with A8CARFile(cart_file, mapped=True) as cart:
+        header = cart._header
+        size = frame_size(header.cart_mode)
+        rom_frames = -(-len(cart.rom_data) // size)
+        count = rom_frames + bool(cart.blob)
+        index = []
+        stored = {}  # SHA-256 of the raw frame → index entry of its first occurrence
+        data_size = 0
+        with a8_cart.AtomicWriter(out_file, spool=True) as f_out:
+            # The index is known only at the end, it is written again then
+            f_out.write(bytes(_CONTAINER_HDR_STRUCT.size + _FRAME_STRUCT.size * count))
+            for section in (cart.rom_data, cart.blob):
+                for frame in _frames(section, size if section is cart.rom_data else max(len(section), 1)):
+                    digest = hashlib.sha256(frame).digest()
+                    if digest not in stored:
+                        packed = compress_frame(frame, level)
+                        stored[digest] = (data_size, len(packed), len(frame), zlib.crc32(frame))
+                        data_size += f_out.write(packed)
+                    index.append(stored[digest])
+            f_out.seek(0)
+            f_out.write(_CONTAINER_HDR_STRUCT.pack(COMPRESSED_MAGIC, CONTAINER_VERSION, codec_id, size, rom_frames, count - rom_frames, header._as_bytes))
+            f_out.write(b''.join(_FRAME_STRUCT.pack(*entry) for entry in index))
+        return {'size': len(header) + len(cart.rom_data) + len(cart.blob), 'compressed_size': _CONTAINER_HDR_STRUCT.size + _FRAME_STRUCT.size * count + data_size,
+                'frames': count, 'stored_frames': len(stored)}
+
+
+def _read_index(read, head: bytes = b''):
+    """(codec name, frame size, CAR header, ROM frame index, BLOB frame index) of the container read by *read*, *head* being its first bytes already read"""
+    head += read(_CONTAINER_HDR_STRUCT.size - len(head))
+    if len(head) < _CONTAINER_HDR_STRUCT.size:
+        raise ValueError('Truncated compressed CAR file')
+    magic, version, codec_id, size, rom_frames, blob_frames, header = _CONTAINER_HDR_STRUCT.unpack(head)
+    if magic != COMPRESSED_MAGIC or version != CONTAINER_VERSION:
+        raise ValueError('Not a compressed CAR file')
+    if codec_id not in _CODEC_NAMES:
+        raise ValueError(f'Unknown codec {codec_id} in compressed CAR file')
+    count = rom_frames + blob_frames
+    raw_index = read(_FRAME_STRUCT.size * count)
+    if len(raw_index) < _FRAME_STRUCT.size * count:
+        raise ValueError('Truncated compressed CAR file')
+    index = list(_FRAME_STRUCT.iter_unpack(raw_index))
+    return _CODEC_NAMES[codec_id], size, A8CARFileHeader(header), index[:rom_frames], index[rom_frames:]
+
+
+def _inflate(decompress_frame, packed, raw_size: int, crc: int) -> bytes:
+    data = decompress_frame(packed, raw_size)
+    if len(data) != raw_size or zlib.crc32(data) != crc:
+        raise ValueError('Corrupt frame in compressed CAR file')
+    return data
+
+
+def load(fobj, head: bytes = b''):
+    """Header, ROM and BLOB (bytearrays) of the compressed container read sequentially from binary stream *fobj*, so pipes work too.
+    *head* are the first bytes of the container already read from *fobj*"""
+    codec, _, header, rom_index, blob_index = _read_index(fobj.read, head)
+    decompress_frame = CODECS[codec][2]
+    data_size = max((offset + packed_size for offset, packed_size, _, _ in rom_index + blob_index), default=0)
+    data = fobj.read(data_size)
+    if len(data) < data_size:
+        raise ValueError('Truncated compressed CAR file')
+    sections = []
+    with memoryview(data) as packed:
+        for section_index in (rom_index, blob_index):
+            # Sized from the index, each frame is copied into place once
+            section = bytearray(sum(raw_size for _, _, raw_size, _ in section_index))
+            with memoryview(section) as view:
+                pos = 0
+                for offset, packed_size, raw_size, crc in section_index:
+                    view[pos:pos + raw_size] = _inflate(decompress_frame, packed[offset:offset + packed_size], raw_size, crc)
+                    pos += raw_size
+            sections.append(section)
+    return header, sections[0], sections[1]
+
+
+class CompressedCart:
+    """Compressed container *fobj* (file name or seekable binary stream) with ROM frames decompressed on demand"""
+
+    def __init__(self, fobj):
+        self._owned = not hasattr(fobj, 'read')
+        self._fobj = open(fobj, 'rb') if self._owned else fobj
+        try:
+            self.codec, self.frame_size, self.header, self._rom_index, self._blob_index = _read_index(self._fobj.read)
+        except Exception:
+            self.close()
+            raise
+        self._data_start = self._fobj.tell()
+        self._decompress = CODECS[self.codec][2]
+        self._cached = (None, None)  # last decompressed frame, banks are usually read in order
+
+    def close(self):
+        if self._owned and self._fobj is not None:
+            self._fobj.close()
+        self._fobj = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def rom_size(self) -> int:
+        return sum(entry[2] for entry in self._rom_index)
+
+    @property
+    def blob_size(self) -> int:
+        return sum(entry[2] for entry in self._blob_index)
+
+    @property
+    def frames(self) -> int:
+        return len(self._rom_index)
+
+    def _read_frame(self, entry) -> bytes:
+        if self._cached[0] != entry:
+            offset, packed_size, raw_size, crc = entry
+            self._fobj.seek(self._data_start + offset)
+            self._cached = (entry, _inflate(self._decompress, self._fobj.read(packed_size), raw_size, crc))
+        return self._cached[1]
+
+    def frame(self, index: int) -> bytes:
+        """ROM frame *index* (frame_size bytes, the last one may be shorter)"""
+        return self._read_frame(self._rom_index[index])
+
+    def read_rom(self, offset: int, size: int) -> bytes:
+        """*size* ROM bytes from *offset*, decompressing just the frames they are in"""
+        chunks = []
+        end = min(offset + size, self.rom_size)
+        while offset < end:
+            frame = self.frame(offset // self.frame_size)
+            start = offset % self.frame_size
+            chunks.append(frame[start:start + end - offset])
+            offset += len(chunks[-1])
+        return b''.join(chunks)
+
+    def bank(self, number: int) -> bytes:
+        """ROM bank *number* of the cart mode, decompressing just its frame"""
+        size = a8_cart.bank_size(self.header.cart_mode) or self.frame_size
+        if not 0 <= number * size < self.rom_size:
+            raise IndexError(f'No bank {number} in {self.rom_size:_} bytes of ROM')
+        return self.read_rom(number * size, size)
+
+    @property
+    def blob(self) -> bytes:
+        return b''.join(self._read_frame(entry) for entry in self._blob_index)
+
+    def write_to(self, fobj) -> int:
+        """Stream the original CAR file into binary stream *fobj* frame by frame, returns number of bytes written"""
+        written = fobj.write(self.header._as_bytes) or 0
+        for entry in self._rom_index + self._blob_index:
+            written += fobj.write(self._read_frame(entry)) or 0
+        return written
+
+
+def verify(fobj, checksum: bool = True) -> list[str]:
+    """Problems found in the compressed container of seekable binary stream *fobj*, empty if it is sound.
+    Checks the stored CAR header like a8_cart.verify_file and the frame index against the file size,
+    with *checksum* also the CRC-32 of every frame and the ROM sum against the stored header"""
+    fobj.seek(0)
+    try:
+        container = CompressedCart(fobj)
+    except ValueError as e:
+        return [str(e)]
+    with container:
+        header = container.header
+        problems = []
+        if header.magic != b'CART':
+            problems.append(f'Bad magic {header.magic!r} of the stored header')
+        mode = header.cart_mode
+        rom_size = container.rom_size
+        if mode.is_virtual:
+            problems.append(f'Unknown cart mode {int(header._cart_mode)}')
+        elif rom_size != mode.mCartSize:
+            problems.append(f'ROM size {rom_size:_} differs from {mode.name} size {mode.mCartSize:_}')
+        if header.blob_offset != (len(header) + rom_size if container.blob_size else 0):
+            problems.append(f'BLOB offset {header.blob_offset:_} does not match the stored ROM ({rom_size:_} bytes) and BLOB ({container.blob_size:_} bytes)')
+        data_size = fobj.seek(0, os.SEEK_END) - container._data_start
+        if any(offset + packed_size > data_size for offset, packed_size, _, _ in container._rom_index + container._blob_index):
+            return problems + ['Frame data past the end of the file']
+        if checksum:
+            sums = {}  # index entry → byte sum, identical frames are decompressed once
+            for number, entry in enumerate(container._rom_index + container._blob_index):
+                if entry not in sums:
+                    try:
+                        sums[entry] = a8_cart.byte_sum(container._read_frame(entry))
+                    except Exception as e:
+                        # CRC mismatch or data the codec can't decode
+                        problems.append(f'Frame {number}: {e}')
+                        return problems
+            total = sum(sums[entry] for entry in container._rom_index)
+            if total & 0xFFFFFFFF != header.csum:
+                problems.append(f'Checksum mismatch: header 0x{header.csum:08X}, ROM 0x{total & 0xFFFFFFFF:08X}')
+    return problems
+
+
+def decompress(in_file, out_file) -> int:
+    """Restore the CAR file of compressed container *in_file* into *out_file*. Returns the size of the CAR file"""
+    with a8_cart.open_input(in_file) as f_in, a8_cart.AtomicWriter(out_file) as f_out:
+        if f_in.seekable():
+            with CompressedCart(f_in) as container:
+                return container.write_to(f_out)
+        # A pipe is decompressed as a whole
+        header, rom, blob = load(f_in)
+        return sum(f_out.write(section) for section in (header._as_bytes, rom, blob))
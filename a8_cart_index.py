@@ -0,0 +1,139 @@
+# SQLite index of a CAR file library.
+# Header fields, sizes and mode properties of each file are recorded once, so questions like "all 5200 carts with a BLOB"
+# are answered by a query instead of opening every file. Files are re-read only when their size or mtime changed.
+import os
+import sqlite3
+
+import a8_cart
+from a8_cart import A8CARFileHeader, ATCartridgeInfo
+
+DEFAULT_DATABASE = 'cart-index.sqlite'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS carts (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    file_size INTEGER NOT NULL,
+    mode INTEGER NOT NULL,
+    mode_name TEXT NOT NULL,
+    csum INTEGER NOT NULL,
+    blob_offset INTEGER NOT NULL,
+    rom_size INTEGER NOT NULL,
+    blob_size INTEGER NOT NULL,
+    system TEXT NOT NULL,
+    banking TEXT NOT NULL,
+    sha256 TEXT,
+    rom_sha256 TEXT
+);
+CREATE INDEX IF NOT EXISTS carts_mode ON carts (mode);
+CREATE INDEX IF NOT EXISTS carts_system ON carts (system, banking);
+CREATE INDEX IF NOT EXISTS carts_sha256 ON carts (sha256);
+'''
+
+COLUMNS = ('path', 'mtime_ns', 'file_size', 'mode', 'mode_name', 'csum', 'blob_offset', 'rom_size', 'blob_size', 'system', 'banking', 'sha256', 'rom_sha256')
+
+_HASH_CHUNK_SIZE = 1 << 20
+
+
+def scan_file(path: str, hashes: bool = False) -> dict:
+    """Index record of CAR file *path*. Only the header is read unless *hashes* are requested"""
+    with open(path, 'rb') as f_in:
+        stat = os.fstat(f_in.fileno())
+        header = A8CARFileHeader(f_in)
+        header_size = len(header)
+        # A BLOB offset outside of the file is recorded as is, the sizes are clamped to the file
+        rom_end = min(max(header.blob_offset or stat.st_size, header_size), stat.st_size)
+        record = {'path': path, 'mtime_ns': stat.st_mtime_ns, 'file_size': stat.st_size, 'mode': int(header.cart_mode), 'mode_name': header.cart_mode.name,
+                  'csum': header.csum, 'blob_offset': header.blob_offset, 'rom_size': rom_end - header_size, 'blob_size': stat.st_size - rom_end,
+                  'system': header.cart_mode.mSystemType.name, 'banking': header.cart_mode.mBankingType.name, 'sha256': None, 'rom_sha256': None}
+        if hashes:
+            import hashlib
+            file_hash = hashlib.sha256(header._as_bytes)
+            rom_hash = hashlib.sha256()
+            pos = header_size
+            while chunk := f_in.read(_HASH_CHUNK_SIZE):
+                file_hash.update(chunk)
+                # The chunk may straddle the ROM/BLOB boundary
+                if pos < rom_end:
+                    rom_hash.update(chunk[:rom_end - pos])
+                pos += len(chunk)
+            record['sha256'] = file_hash.hexdigest()
+            record['rom_sha256'] = rom_hash.hexdigest()
+    return record
+
+
+def _scan_job(path: str, hashes: bool):
+    try:
+        return scan_file(path, hashes)
+    except (OSError, ValueError, TypeError):
+        # Not a CAR file, or vanished since the directory was listed
+        return None
+
+
+class CartIndex:
+    """Index database *database* (file name, created if missing)"""
+
+    def __init__(self, database=DEFAULT_DATABASE):
+        self.db = sqlite3.connect(database)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def update(self, directory: str, hashes: bool = False, jobs: int = None) -> dict:
+        """Index the CAR files below *directory*, re-reading new and changed files only. Files removed from *directory* are dropped.
+        *hashes* adds SHA-256 of the file and the ROM, which means reading the whole files. Files are read by *jobs* threads"""
+        import concurrent.futures
+        directory = os.path.abspath(directory)
+        prefix = os.path.join(directory, '')
+        known = {row['path']: row for row in self.db.execute('SELECT path, mtime_ns, file_size, sha256 FROM carts WHERE substr(path, 1, ?) = ?', (len(prefix), prefix))}
+        paths = a8_cart.find_car_files(directory)
+        stale = []
+        for path in paths:
+            row = known.get(path)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if row is None or row['mtime_ns'] != stat.st_mtime_ns or row['file_size'] != stat.st_size or (hashes and row['sha256'] is None):
+                stale.append(path)
+        removed = set(known) - set(paths)
+        # Reading headers and hashing are I/O and hashlib bound, both release the GIL
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            records = list(executor.map(_scan_job, stale, [hashes] * len(stale)))
+        skipped = [path for path, record in zip(stale, records) if record is None]
+        with self.db:
+            self.db.executemany('DELETE FROM carts WHERE path = ?', ((path,) for path in removed.union(skipped)))
+            self.db.executemany(f'INSERT OR REPLACE INTO carts ({", ".join(COLUMNS)}) VALUES ({", ".join("?" * len(COLUMNS))})',
+                                (tuple(record[column] for column in COLUMNS) for record in records if record is not None))
+        return {'files': len(paths), 'indexed': len(stale) - len(skipped), 'unchanged': len(paths) - len(stale), 'skipped': len(skipped), 'removed': len(removed)}
+
+    def query(self, mode: ATCartridgeInfo = None, system: str = None, banking: str = None, has_blob: bool = None, min_size: int = None, max_size: int = None,
+              csum: int = None, sha256: str = None, path: str = None) -> list[dict]:
+        """Records matching all given filters, ordered by path. *min_size*/*max_size* apply to the ROM size, *path* is a glob pattern"""
+        conditions = []
+        params = []
+        for column, value in (('mode', None if mode is None else int(mode)), ('system', system), ('banking', banking), ('csum', csum), ('sha256', sha256)):
+            if value is not None:
+                conditions.append(f'{column} = ?')
+                params.append(value)
+        if has_blob is not None:
+            conditions.append('blob_size > 0' if has_blob else 'blob_size = 0')
+        if min_size is not None:
+            conditions.append('rom_size >= ?')
+            params.append(min_size)
+        if max_size is not None:
+            conditions.append('rom_size <= ?')
+            params.append(max_size)
+        if path is not None:
+            conditions.append('path GLOB ?')
+            params.append(path)
+        where = f' WHERE {" AND ".join(conditions)}' if conditions else ''
+        return [dict(row) for row in self.db.execute(f'SELECT * FROM carts{where} ORDER BY path', params)]
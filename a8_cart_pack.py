@@ -0,0 +1,103 @@
+# Multicart builder, packs many ROM files into the banks of one large banked cart mode (MegaCart, The!Cart, XEGS, SIC...).
+# Each ROM gets a slot of whole banks. By default slots are rounded up to a power of two banks and aligned to their size,
+# the way bank registers of the menu loaders mask bank numbers. Slots are placed first fit decreasing,
+# and the image is streamed to disk ROM by ROM, so its size is not limited by memory.
+import os
+import struct
+from collections import namedtuple
+
+import a8_cart
+from a8_cart import A8CARFileHeader, ATCartridgeInfo, BankingType
+
+Placement = namedtuple('Placement', ('file_name', 'size', 'bank', 'banks'))
+
+# Placement table BLOB, read by the menu loader on the Atari, so little-endian:
+# magic, bank size, number of entries, then per ROM first bank, number of banks, ROM size, name (UTF-8, zero padded)
+PLACEMENT_MAGIC = b'A8PK'
+_PLACEMENT_HDR_STRUCT = struct.Struct('<4sLH')
+_PLACEMENT_STRUCT = struct.Struct('<HHL24s')
+
+_COPY_CHUNK = 1 << 20
+
+
+def plan_pack(sizes: list[int], mode: ATCartridgeInfo, compact: bool = False, reserve: int = 0) -> list[tuple[int, int]]:
+    """First bank and number of banks for ROMs of *sizes* in cart *mode*, in the order of *sizes*.
+    *compact* slots take just the banks a ROM needs, without power of two rounding and alignment. The first *reserve* banks stay free"""
+    mode = ATCartridgeInfo(mode)
+    if mode.mBankingType == BankingType.kBankNone or mode.is_virtual:
+        raise ValueError(f'{mode.name} has no banks to pack ROMs into')
+    bank = a8_cart.bank_size(mode)
+    used = bytearray(mode.mCartSize // bank)
+    used[:reserve] = b'\1' * min(reserve, len(used))
+    slots = [None] * len(sizes)
+    for index in sorted(range(len(sizes)), key=lambda index: -sizes[index]):
+        if sizes[index] <= 0:
+            raise ValueError('Empty ROM')
+        banks = -(-sizes[index] // bank)
+        if not compact:
+            banks = 1 << (banks - 1).bit_length()
+        align = 1 if compact else banks
+        free = bytes(banks)
+        pos = 0
+        while True:
+            pos = used.find(free, pos)
+            if pos < 0:
+                raise RuntimeError(f'ROMs don\'t fit into {mode.name}: no room for {sizes[index]:_} bytes ({banks} banks of {bank:_})')
+            if pos % align == 0:
+                break
+            pos += align - pos % align
+        used[pos:pos + banks] = b'\1' * banks
+        slots[index] = (pos, banks)
+    return slots
+
+
+def _record_name(file_name: str) -> bytes:
+    # UTF-8 file name cut to the record field on a character boundary, so it always decodes
+    return os.path.basename(file_name).encode()[:_PLACEMENT_STRUCT.size - 8].decode(errors='ignore').encode()
+
+
+def placement_blob(placements: list[Placement], bank_size: int) -> bytes:
+    records = [_PLACEMENT_STRUCT.pack(placement.bank, placement.banks, placement.size, _record_name(placement.file_name)) for placement in placements]
+    return _PLACEMENT_HDR_STRUCT.pack(PLACEMENT_MAGIC, bank_size, len(records)) + b''.join(records)
+
+
+def pack(rom_files: list[str], mode: ATCartridgeInfo, cart_file, compact: bool = False, reserve: int = 0, with_blob: bool = False, fill: int = 0xFF) -> list[Placement]:
+    """Pack *rom_files* into a CAR file *cart_file* of *mode*, unused banks filled with *fill*.
+    With *with_blob* the placement table is stored as the BLOB. Returns the placements in the order of *rom_files*"""
+    mode = ATCartridgeInfo(mode)
+    sizes = [os.path.getsize(file_name) for file_name in rom_files]
+    bank = a8_cart.bank_size(mode)
+    placements = [Placement(file_name, size, *slot) for file_name, size, slot in zip(rom_files, sizes, plan_pack(sizes, mode, compact, reserve))]
+    blob = placement_blob(placements, bank) if with_blob else b''
+    header = A8CARFileHeader(typ=mode, blob_offset=len(A8CARFileHeader()) + mode.mCartSize if blob else 0)
+    fill_chunk = bytes((fill,)) * _COPY_CHUNK
+    csum = 0
+
+    def write_fill(f_out, size):
+        nonlocal csum
+        csum += fill * size
+        for pos in range(0, size, _COPY_CHUNK):
+            f_out.write(fill_chunk[:min(_COPY_CHUNK, size - pos)])
+
+    with a8_cart.AtomicWriter(cart_file, spool=True) as f_out:
+        # Checksum is known only at the end, the header is written again then
+        f_out.write(header._as_bytes)
+        pos = 0
+        for placement in sorted(placements, key=lambda placement: placement.bank):
+            write_fill(f_out, placement.bank * bank - pos)
+            with open(placement.file_name, 'rb') as f_rom:
+                copied = 0
+                while chunk := f_rom.read(_COPY_CHUNK):
+                    f_out.write(chunk)
+                    csum += a8_cart.byte_sum(chunk)
+                    copied += len(chunk)
+            if copied != placement.size:
+                raise RuntimeError(f'{placement.file_name} changed while packing')
+            write_fill(f_out, placement.banks * bank - copied)
+            pos = (placement.bank + placement.banks) * bank
+        write_fill(f_out, mode.mCartSize - pos)
+        f_out.write(blob)
+        header.csum = csum & 0xFFFFFFFF
+        f_out.seek(0)
+        f_out.write(header._as_bytes)
+    return placements
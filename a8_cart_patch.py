@@ -0,0 +1,248 @@
+# Binary delta patches between CAR files.
+# A patch holds the target header and one operation list per section (ROM, BLOB), each against the same section of the source,
+# so a ROM change never has to be matched against BLOB content and vice versa. Operations are BPS-like:
+#   SOURCE_READ  copy from the source at the current output offset (unchanged bytes)
+#   TARGET_READ  literal bytes stored in the patch
+#   SOURCE_COPY  copy from elsewhere in the source (moved banks), offset relative to the end of the previous copy
+#   FILL         repeat one byte (e.g. 0xFF padding of a grown ROM)
+# Everything after the fixed header is zlib compressed. Patches apply as a stream against a mapped source,
+# and the result is verified against the target header checksum and CRC-32 before it replaces the output file.
+import struct
+import zlib
+
+import a8_cart
+from a8_cart import A8CARFile, A8CARFileHeader
+
+PATCH_MAGIC = b'A8CP'
+PATCH_VERSION = 1
+# magic, version, source size, source CRC-32, target size, target CRC-32, target CAR header
+_PATCH_HDR_STRUCT = struct.Struct('>4sBLLLL16s')
+
+SOURCE_READ, TARGET_READ, SOURCE_COPY, FILL = range(4)
+
+_BLOCK_SIZE = 32       # granularity of the moved block lookup
+_MIN_MATCH = 8         # shorter unchanged spans are cheaper as literals
+_MIN_RUN = 16          # shortest byte run encoded as FILL
+_COMPARE_CHUNK = 4096
+_IO_CHUNK = 1 << 16
+
+
+def _match_len(a, a_pos: int, b, b_pos: int) -> int:
+    """Number of equal bytes of *a* from *a_pos* and *b* from *b_pos*. Compares in chunks, narrowing down on the first difference"""
+    limit = min(len(a) - a_pos, len(b) - b_pos)
+    length = 0
+    step = _COMPARE_CHUNK
+    while length < limit:
+        n = min(step, limit - length)
+        if a[a_pos + length:a_pos + length + n] == b[b_pos + length:b_pos + length + n]:
+            length += n
+        elif n == 1:
+            break
+        else:
+            step = n // 2
+    return length
+
+
+def _run_len(data, pos: int) -> int:
+    """Number of bytes of *data* from *pos* equal to the byte at *pos*"""
+    pattern = bytes((data[pos],)) * _COMPARE_CHUNK
+    limit = len(data) - pos
+    length = 0
+    step = _COMPARE_CHUNK
+    while length < limit:
+        n = min(step, limit - length)
+        if data[pos + length:pos + length + n] == pattern[:n]:
+            length += n
+        elif n == 1:
+            break
+        else:
+            step = n // 2
+    return length
+
+
+def _diff(source, target):
+    """Operations building *target* from *source*: (SOURCE_READ, length), (TARGET_READ, data), (SOURCE_COPY, offset, length), (FILL, length, value)"""
+    blocks = {}
+    for pos in range(len(source) - _BLOCK_SIZE, -1, -_BLOCK_SIZE):
+        # Walk backwards, so the first occurrence of a block wins
+        blocks[bytes(source[pos:pos + _BLOCK_SIZE])] = pos
+    pos = 0
+    literal = 0
+    size = len(target)
+    while pos < size:
+        op = None
+        if pos < len(source) and source[pos] == target[pos] and (length := _match_len(source, pos, target, pos)) >= _MIN_MATCH:
+            op = (SOURCE_READ, length)
+        elif pos + _MIN_RUN <= size and target[pos] == target[pos + _MIN_RUN - 1] and (length := _run_len(target, pos)) >= _MIN_RUN:
+            op = (FILL, length, target[pos])
+        elif (offset := blocks.get(bytes(target[pos:pos + _BLOCK_SIZE]))) is not None:
+            length = _match_len(source, offset, target, pos)
+            op = (SOURCE_COPY, offset, length)
+        if op is None:
+            literal += 1
+            pos += 1
+            continue
+        if literal:
+            yield TARGET_READ, target[pos - literal:pos]
+            literal = 0
+        yield op
+        pos += length
+    if literal:
+        yield TARGET_READ, target[pos - literal:pos]
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _encode_section(source, target, compressor) -> bytes:
+    chunks = [_varint(len(target))]
+    source_pos = 0
+    for op in _diff(source, target):
+        if op[0] == TARGET_READ:
+            chunks.append(_varint((len(op[1]) - 1) << 2 | TARGET_READ))
+            chunks.append(bytes(op[1]))
+        elif op[0] == SOURCE_COPY:
+            _, offset, length = op
+            relative = offset - source_pos
+            # Zigzag encoding of the signed relative offset
+            chunks.append(_varint((length - 1) << 2 | SOURCE_COPY) + _varint(relative << 1 if relative >= 0 else (-relative << 1) - 1))
+            source_pos = offset + length
+        elif op[0] == FILL:
+            chunks.append(_varint((op[1] - 1) << 2 | FILL) + bytes((op[2],)))
+        else:
+            chunks.append(_varint((op[1] - 1) << 2 | SOURCE_READ))
+    return compressor.compress(b''.join(chunks))
+
+
+def _cart_crc(cart: A8CARFile) -> int:
+    crc = zlib.crc32(cart._header._as_bytes)
+    for section in (cart.rom_data, cart.blob):
+        crc = zlib.crc32(section, crc)
+    return crc
+
+
+def _cart_size(cart: A8CARFile) -> int:
+    return len(cart._header) + len(cart.rom_data) + len(cart.blob)
+
+
+def make_patch(source_file, target_file, patch_file) -> dict:
+    """Write the delta turning CAR file *source_file* into CAR file *target_file* to *patch_file*. Returns patch and target sizes"""
+    with A8CARFile(source_file, mapped=True) as source, A8CARFile(target_file, mapped=True) as target:
+        if target._header.csum != target.data_csum:
+            raise ValueError(f'Checksum of {target_file} is wrong (header: 0x{target._header.csum:08X}, ROM: 0x{target.data_csum:08X}), fix it before making a patch')
+        # The target header is stored as is, so even a BLOB offset that doesn't follow the ROM is reproduced
+        header = _PATCH_HDR_STRUCT.pack(PATCH_MAGIC, PATCH_VERSION, _cart_size(source), _cart_crc(source), _cart_size(target), _cart_crc(target), target._header._as_bytes)
+        compressor = zlib.compressobj(9)
+        with a8_cart.AtomicWriter(patch_file) as f_out:
+            written = f_out.write(header)
+            for source_section, target_section in ((source.rom_data, target.rom_data), (source.blob, target.blob)):
+                written += f_out.write(_encode_section(source_section, target_section, compressor))
+            written += f_out.write(compressor.flush())
+        return {'patch_size': written, 'target_size': _cart_size(target)}
+
+
+class _InflateReader:
+    """read(n) of exactly n bytes from the zlib stream following the patch header"""
+
+    def __init__(self, fobj):
+        self._fobj = fobj
+        self._inflate = zlib.decompressobj()
+        self._buffer = bytearray()
+        self._pos = 0
+
+    def read(self, size: int) -> bytes:
+        if len(self._buffer) - self._pos < size:
+            del self._buffer[:self._pos]
+            self._pos = 0
+            while len(self._buffer) < size:
+                # Inflate in bounded steps, a few bytes of patch can expand to a lot of output
+                data = self._inflate.unconsumed_tail or self._fobj.read(_IO_CHUNK)
+                if not data:
+                    raise ValueError('Truncated patch')
+                self._buffer += self._inflate.decompress(data, _IO_CHUNK)
+        data = bytes(self._buffer[self._pos:self._pos + size])
+        self._pos += size
+        return data
+
+    def varint(self) -> int:
+        value = shift = 0
+        while True:
+            byte = self.read(1)[0]
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+
+def _write_source(source, pos: int, length: int, write):
+    if pos < 0 or pos + length > len(source):
+        raise ValueError('Corrupt patch')
+    write(source[pos:pos + length])
+
+
+def _apply_section(source, patch: _InflateReader, write):
+    size = patch.varint()
+    pos = source_pos = 0
+    while pos < size:
+        op = patch.varint()
+        kind, length = op & 3, (op >> 2) + 1
+        if pos + length > size:
+            raise ValueError('Corrupt patch')
+        if kind == SOURCE_READ:
+            _write_source(source, pos, length, write)
+        elif kind == TARGET_READ:
+            for done in range(0, length, _IO_CHUNK):
+                write(patch.read(min(_IO_CHUNK, length - done)))
+        elif kind == SOURCE_COPY:
+            relative = patch.varint()
+            source_pos += -((relative + 1) >> 1) if relative & 1 else relative >> 1
+            _write_source(source, source_pos, length, write)
+            source_pos += length
+        else:
+            write(patch.read(1) * length)
+        pos += length
+
+
+def apply_patch(source_file, patch_file, target_file) -> int:
+    """Rebuild the target CAR file of *patch_file* from CAR file *source_file* into *target_file*. Returns the size of the target.
+    *target_file* is only replaced if the result matches the checksum of its header and the CRC-32 recorded in the patch"""
+    with a8_cart.AtomicWriter(target_file, spool=True) as f_out, A8CARFile(source_file, mapped=True) as source, a8_cart.open_input(patch_file) as f_patch:
+        patch_header = f_patch.read(_PATCH_HDR_STRUCT.size)
+        if len(patch_header) < _PATCH_HDR_STRUCT.size:
+            raise ValueError(f'{patch_file} is not a CAR patch')
+        magic, version, source_size, source_crc, target_size, target_crc, target_header = _PATCH_HDR_STRUCT.unpack(patch_header)
+        if magic != PATCH_MAGIC or version != PATCH_VERSION:
+            raise ValueError(f'{patch_file} is not a CAR patch')
+        if _cart_size(source) != source_size or _cart_crc(source) != source_crc:
+            raise ValueError(f'{source_file} is not the CAR file the patch was made for')
+        header = A8CARFileHeader(target_header)
+        f_out.write(target_header)
+        crc = zlib.crc32(target_header)
+        csum = 0
+        written = len(target_header)
+        patch = _InflateReader(f_patch)
+
+        def write_rom(data):
+            nonlocal crc, csum, written
+            f_out.write(data)
+            crc = zlib.crc32(data, crc)
+            csum += a8_cart.byte_sum(data)
+            written += len(data)
+
+        def write_blob(data):
+            nonlocal crc, written
+            f_out.write(data)
+            crc = zlib.crc32(data, crc)
+            written += len(data)
+
+        _apply_section(source.rom_data, patch, write_rom)
+        _apply_section(source.blob, patch, write_blob)
+        if csum & 0xFFFFFFFF != header.csum or crc != target_crc or written != target_size:
+            raise ValueError('Patched CAR file does not match its checksum, the patch or the source file is corrupt')
+    return written
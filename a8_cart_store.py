@@ -0,0 +1,134 @@
+# Content addressed store of CAR files.
+# ROM banks and BLOBs are kept once per distinct content, named by their SHA-256, so banks shared between cartridges
+# (0xFF padding, common loaders, OS banks) take disk space only once. CAR files are reassembled from their bank list on demand.
+import hashlib
+import json
+import os
+
+import a8_cart
+from a8_cart import A8CARFile, A8CARFileHeader
+
+
+class BankStore:
+    """Store rooted at directory *root*. objects/ holds bank and BLOB contents, carts/ one JSON bank list per cartridge"""
+
+    def __init__(self, root):
+        self.root = os.fspath(root)
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.root, 'objects', digest[:2], digest[2:])
+
+    def _cart_path(self, name: str) -> str:
+        if not name or name.startswith('.') or os.sep in name or (os.altsep and os.altsep in name):
+            raise ValueError(f'Invalid cartridge name in store: "{name}"')
+        return os.path.join(self.root, 'carts', name + '.json')
+
+    def put_object(self, data, sync: bool = True) -> tuple[str, bool]:
+        """Store *data* unless already present. Returns its digest and whether it was new to the store.
+        With *sync* False the object is not flushed to disk, the caller has to sync_objects before anything refers to it"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._object_path(digest)
+        if os.path.exists(path):
+            return digest, False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with a8_cart.AtomicWriter(path, sync=sync) as f_out:
+            a8_cart.write_chunked(f_out, data)
+        return digest, True
+
+    def sync_objects(self, digests):
+        """Flush the objects of *digests* to disk. A single system wide sync where available, one fsync per object otherwise"""
+        if hasattr(os, 'sync'):
+            os.sync()
+            return
+        for digest in digests:
+            with open(self._object_path(digest), 'r+b') as f_object:
+                os.fsync(f_object.fileno())
+
+    def add(self, cart_file, name: str = None) -> dict:
+        """Add CAR file *cart_file* as *name* (default is the file name), replacing a cartridge of the same name.
+        Returns the stored entry with the number of banks and bytes that were new to the store"""
+        if name is None:
+            name = os.path.basename(cart_file if isinstance(cart_file, (str, os.PathLike)) else cart_file.name)
+        entry_path = self._cart_path(name)
+        new_objects = new_bytes = 0
+        # Objects are synced all at once before the entry refers to them, not one fsync per bank
+        unsynced = []
+        file_hash = hashlib.sha256()
+        with A8CARFile(cart_file, mapped=True) as cart:
+            # Keep the stored header values, so the reassembled file is identical to the added one
+            mode = cart._header.cart_mode
+            header = A8CARFileHeader(typ=mode, csum=cart._header.csum, blob_offset=len(cart._header) + len(cart.rom_data) if cart.blob else 0)
+            file_hash.update(header._as_bytes)
+            banks = []
+            for bank in a8_cart.split_banks(cart.rom_data, mode):
+                # Release each bank view right away, the mapping can't be closed while any is alive
+                with bank:
+                    digest, is_new = self.put_object(bank, sync=False)
+                    file_hash.update(bank)
+                    new_bytes += len(bank) if is_new else 0
+                banks.append(digest)
+                new_objects += is_new
+                if is_new:
+                    unsynced.append(digest)
+            blob = None
+            if cart.blob:
+                blob, is_new = self.put_object(cart.blob, sync=False)
+                file_hash.update(cart.blob)
+                new_objects += is_new
+                new_bytes += len(cart.blob) if is_new else 0
+                if is_new:
+                    unsynced.append(blob)
+            entry = {'name': name, 'mode': int(mode), 'csum': header.csum, 'rom_size': len(cart.rom_data), 'bank_size': a8_cart.bank_size(mode),
+                     'banks': banks, 'blob': blob, 'blob_size': len(cart.blob), 'size': len(cart), 'sha256': file_hash.hexdigest()}
+        if unsynced:
+            self.sync_objects(unsynced)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        with a8_cart.AtomicWriter(entry_path) as f_out:
+            f_out.write(json.dumps(entry, indent=1).encode())
+        return dict(entry, new_objects=new_objects, new_bytes=new_bytes)
+
+    def entry(self, name: str) -> dict:
+        try:
+            with open(self._cart_path(name), 'rb') as f_in:
+                return json.load(f_in)
+        except FileNotFoundError:
+            raise KeyError(f'No cartridge "{name}" in store {self.root}') from None
+
+    def names(self) -> list[str]:
+        try:
+            return sorted(file_name[:-len('.json')] for file_name in os.listdir(os.path.join(self.root, 'carts')) if file_name.endswith('.json'))
+        except FileNotFoundError:
+            return []
+
+    def write_cart(self, name: str, fobj) -> int:
+        """Reassemble cartridge *name* into binary stream *fobj* bank by bank, verifying its SHA-256. Returns number of bytes written"""
+        entry = self.entry(name)
+        header = A8CARFileHeader(typ=entry['mode'], csum=entry['csum'], blob_offset=len(A8CARFileHeader()) + entry['rom_size'] if entry['blob'] else 0)
+        file_hash = hashlib.sha256(header._as_bytes)
+        written = fobj.write(header._as_bytes) or 0
+        for digest in entry['banks'] + ([entry['blob']] if entry['blob'] else []):
+            with open(self._object_path(digest), 'rb') as f_in:
+                data = f_in.read()
+            file_hash.update(data)
+            written += fobj.write(data) or 0
+        if file_hash.hexdigest() != entry['sha256']:
+            raise RuntimeError(f'Cartridge "{name}" is corrupt in store {self.root}')
+        return written
+
+    def get(self, name: str, file_name) -> int:
+        """Reassemble cartridge *name* into file *file_name*, which is only replaced once complete and verified"""
+        with a8_cart.AtomicWriter(file_name, spool=True) as f_out:
+            return self.write_cart(name, f_out)
+
+    def stats(self) -> dict:
+        """Number and total size of the stored cartridges against the objects actually kept on disk"""
+        entries = [self.entry(name) for name in self.names()]
+        objects = object_bytes = 0
+        for dir_path, _, file_names in os.walk(os.path.join(self.root, 'objects')):
+            for file_name in file_names:
+                if not file_name.endswith('.tmp'):
+                    objects += 1
+                    object_bytes += os.path.getsize(os.path.join(dir_path, file_name))
+        cart_bytes = sum(entry['size'] for entry in entries)
+        return {'carts': len(entries), 'cart_bytes': cart_bytes, 'banks': sum(len(entry['banks']) for entry in entries),
+                'objects': objects, 'object_bytes': object_bytes, 'ratio': cart_bytes / object_bytes if object_bytes else 0.0}
@@ -0,0 +1,168 @@
+#Throughput and peak memory benchmark of the CAR file operations for every cart mode size
+import argparse
+import contextlib
+import io
+import json
+import pathlib
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import a8_cart
+import cart_tool
+from a8_cart import A8CARFile
+
+BLOB_SIZE = 0x10000
+
+
+def best_time(func, repeat: int, setup=None) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def peak_memory(func, setup=None) -> int:
+    """Peak of Python allocations during *func* [bytes]. Mapped file content is not counted, as it is not allocated"""
+    if setup:
+        setup()
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def quiet(func):
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            func()
+    return run
+
+
+def cart_cases(work_dir: pathlib.Path, mode: a8_cart.ATCartridgeInfo, rnd: random.Random) -> dict:
+    """name → (function, setup or None) of the cases timed for *mode*"""
+    size = mode.mCartSize
+    rom_file = work_dir / 'bench.rom'
+    car_file = work_dir / 'bench.car'
+    work_file = work_dir / 'work.car'
+    half_file = work_dir / 'half.car'
+    blob_file = work_dir / 'bench.blob'
+    rom_file.write_bytes(rnd.randbytes(size))
+    blob_file.write_bytes(rnd.randbytes(BLOB_SIZE))
+    cart = A8CARFile()
+    cart.rom_data = rom_file.read_bytes()
+    cart.header.cart_mode = mode
+    a8_cart.save_atomic(cart, car_file)
+    # Half size ROM, so settype --adjust-size has to extend it
+    cart.truncate_rom(size // 2)
+    a8_cart.save_atomic(cart, half_file)
+    del cart
+    loaded = A8CARFile(car_file)
+
+    def fresh_csum():
+        loaded._data_csum = None
+
+    def rom2car():
+        with open(rom_file, 'rb') as f_rom:
+            cart_tool.cmd_rom2car(rom_file=f_rom, cart_file=str(work_file), cart_type=mode)
+
+    def set_blob():
+        with open(blob_file, 'rb') as f_blob:
+            cart_tool.cmd_set_blob(cart_file=str(work_file), blob_file=f_blob)
+
+    return {
+        'load': (lambda: A8CARFile(car_file), None),
+        'load_mapped': (lambda: A8CARFile(car_file, mapped=True).close(), None),
+        'data_csum': (lambda: loaded.data_csum, fresh_csum),
+        'header': (lambda: loaded.header, fresh_csum),
+        'bytes': (lambda: bytes(loaded), None),
+        'rom2car': (quiet(rom2car), None),
+        'settype_adjust': (lambda: cart_tool.cmd_set_type(cart_file=str(work_file), cart_type=mode, adjust_size=True), lambda: shutil.copyfile(half_file, work_file)),
+        'setblob': (set_blob, lambda: shutil.copyfile(car_file, work_file)),
+    }
+
+
+def lcd_cases(rnd: random.Random) -> dict:
+    """(name, number of pixels) → (function, setup) of the LCD raster encoder cases, empty without Pillow"""
+    try:
+        from PIL import Image
+    except ImportError:
+        print('Pillow not installed, LCD encoder cases skipped', file=sys.stderr)
+        return {}
+    import pil_lcd_raster  # registers the encoders
+    cases = {}
+    for w, h in ((128, 64), (640, 480)):
+        source = Image.frombytes('RGBA', (w, h), rnd.randbytes(w * h * 4))
+        for mode in ('1', 'L'):
+            im = source.convert(mode)
+            for fmt in ('rawlcdbin', 'rawlcdC'):
+                cases[(f'lcd_{fmt}_{mode}', w * h)] = (lambda im=im, fmt=fmt: im.save(io.BytesIO(), fmt), None)
+    return cases
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure throughput and peak memory of the CAR file operations for every cart mode size, and of the LCD raster encoders')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Number of runs per case, the best one is reported')
+    parser.add_argument('--max-size', type=lambda val: int(val, 0), default=None, help='Skip cart sizes above this many bytes. Default is all sizes up to 128M.')
+    parser.add_argument('-k', '--cases', type=str, default=None, help='Comma separated list of case names to run. Default is all.')
+    parser.add_argument('-b', '--baseline', type=pathlib.Path, help='Baseline JSON to compare with (as written by --save)')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.5, help='Allowed slowdown and memory growth relative to the baseline (0.5 = 50%%)')
+    parser.add_argument('-s', '--save', type=pathlib.Path, help='Write results as baseline JSON')
+    args = parser.parse_args()
+    selected = set(args.cases.split(',')) if args.cases else None
+
+    rnd = random.Random(1)
+    modes = {}
+    for mode in a8_cart.REAL_MODES:
+        if mode.mCartSize and (args.max_size is None or mode.mCartSize <= args.max_size):
+            modes.setdefault(mode.mCartSize, mode)
+    results = {}
+    baseline = json.loads(args.baseline.read_text()) if args.baseline else {}
+    failed = False
+
+    def run(name: str, size: int, func, setup):
+        nonlocal failed
+        key = f'{name}@{size}'
+        elapsed = best_time(func, args.repeat, setup)
+        peak = peak_memory(func, setup)
+        results[key] = {'time': elapsed, 'peak': peak}
+        verdict = ''
+        if key in baseline:
+            # Timer noise of the sub-millisecond cases is not reported either
+            if elapsed > baseline[key]['time'] * (1 + args.tolerance) + 0.0002:
+                verdict += f' slower than baseline ({baseline[key]["time"] * 1000:.2f} ms)'
+            # Small allocations vary between runs, growth below 64K is not reported
+            if peak > baseline[key]['peak'] * (1 + args.tolerance) + 0x10000:
+                verdict += f' more memory than baseline ({baseline[key]["peak"] / 1024:.0f} KiB)'
+        failed |= bool(verdict)
+        unit = 'Mpx/s' if name.startswith('lcd_') else 'MB/s'
+        print(f'{name:22} {size:>11_} {elapsed * 1000:10.2f} ms {size / elapsed / 1e6:9.1f} {unit:5} {peak / 1024:10.0f} KiB{verdict}', flush=True)
+
+    print(f'{"case":22} {"size":>11} {"time":>13} {"throughput":>15} {"peak memory":>14}')
+    with tempfile.TemporaryDirectory() as work_dir:
+        for size, mode in sorted(modes.items()):
+            cases = {name: case for name, case in cart_cases(pathlib.Path(work_dir), mode, rnd).items() if selected is None or name in selected}
+            for name, (func, setup) in cases.items():
+                run(name, size, func, setup)
+    for (name, pixels), (func, setup) in lcd_cases(rnd).items():
+        if selected is None or name in selected:
+            run(name, pixels, func, setup)
+
+    if args.save:
+        args.save.write_text(json.dumps(results, indent=1))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
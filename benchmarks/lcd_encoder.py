@@ -0,0 +1,71 @@
+#Benchmark of the bulk LCD raster encoder against the per pixel encoder
+import argparse
+import pathlib
+import random
+import sys
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+try:
+    from PIL import Image, ImageFile
+except ImportError:
+    print('Need PILLOW library for image read/write, use python -m pip install Pillow', file=sys.stderr)
+    raise
+
+import pil_lcd_raster
+
+
+class PixelEncoder(pil_lcd_raster.LCDRasterEncoder):
+    BULK_MODES = ()
+
+
+Image.register_encoder('rawlcd_pixel', PixelEncoder)
+
+
+def encode(im, encoder_name: str) -> bytes:
+    encoder = Image._getencoder(im.mode, encoder_name, im.mode, ())
+    chunks = []
+    try:
+        encoder.setimage(im.im, (0, 0) + im.size)
+        while True:
+            l, s, d = encoder.encode(max(ImageFile.MAXBLOCK, im.size[0]))
+            chunks.append(bytes(d[:l]))
+            if s:
+                break
+    finally:
+        encoder.cleanup()
+    return b''.join(chunks)
+
+
+def best_time(func, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the bulk and the per pixel LCD raster encoders')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Number of runs per case, the best one is reported')
+    parser.add_argument('--sizes', type=str, default='128x64,320x240,640x480', help='Comma separated list of WIDTHxHEIGHT image sizes')
+    args = parser.parse_args()
+
+    rnd = random.Random(1)
+    print(f'{"mode":5} {"size":>9} {"pixel":>10} {"bulk":>10} {"speedup":>8}  (NumPy {"on" if pil_lcd_raster._get_numpy() else "off"})')
+    for size in args.sizes.split(','):
+        w, h = map(int, size.split('x'))
+        source = Image.frombytes('RGBA', (w, h), rnd.randbytes(w * h * 4))
+        for mode in ('1', 'L', 'RGB', 'RGBA'):
+            im = source.convert(mode)
+            if encode(im, 'rawlcd') != encode(im, 'rawlcd_pixel'):
+                raise AssertionError(f'Encoders differ for mode {mode} {size}')
+            pixel = best_time(lambda: encode(im, 'rawlcd_pixel'), args.repeat)
+            bulk = best_time(lambda: encode(im, 'rawlcd'), args.repeat)
+            print(f'{mode:5} {size:>9} {pixel * 1000:8.2f}ms {bulk * 1000:8.2f}ms {pixel / bulk:7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#Startup time benchmark of cart-tool.py based on python -X importtime
+import argparse
+import json
+import os
+import pathlib
+import re
+import subprocess
+import sys
+import tempfile
+
+REPO_DIR = pathlib.Path(__file__).resolve().parent.parent
+CART_TOOL = REPO_DIR / 'cart-tool.py'
+
+# Modules only some subcommands need, they must not be imported by the short commands
+DEFERRED_MODULES = ('json', 'csv', 'concurrent.futures', 'multiprocessing', 'dataclasses', 'tempfile', 'sqlite3', 'hashlib', 'pathlib')
+
+_IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def importtime(args: list[str]) -> dict[str, int]:
+    """Run cart-tool.py with *args* under -X importtime, returns top-level module → cumulative import time [µs]"""
+    env = dict(os.environ)
+    # Bytecode caching is part of what is measured
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    proc = subprocess.run([sys.executable, '-X', 'importtime', str(CART_TOOL), *args], env=env, cwd=REPO_DIR, capture_output=True, text=True)
+    if proc.returncode:
+        raise RuntimeError(f'cart-tool.py {" ".join(args)} failed: {proc.stdout}{proc.stderr}')
+    modules = {}
+    for line in proc.stderr.splitlines():
+        if match := _IMPORTTIME_LINE.match(line):
+            modules[match[4]] = int(match[2])
+    return modules
+
+
+def measure(args: list[str], repeat: int) -> dict:
+    runs = [importtime(args) for _ in range(repeat + 1)][1:]  # first run warms up the bytecode cache
+    total = min(times.get('cart_tool_client', 0) + times.get('cart_tool', 0) for times in runs)
+    return {'import_us': total, 'modules': sorted(runs[0])}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure cart-tool.py import time per subcommand with python -X importtime')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Number of measured runs, the best one is reported')
+    parser.add_argument('-b', '--baseline', type=pathlib.Path, help='Baseline JSON to compare with (as written by --save)')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.5, help='Allowed slowdown relative to the baseline (0.5 = 50%%)')
+    parser.add_argument('-s', '--save', type=pathlib.Path, help='Write results as baseline JSON')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        car_file = pathlib.Path(work_dir) / 'bench.car'
+        rom_file = pathlib.Path(work_dir) / 'bench.rom'
+        rom_file.write_bytes(b'\xff' * 0x2000)
+        subprocess.run([sys.executable, str(CART_TOOL), 'rom2car', str(rom_file), str(car_file)], check=True, capture_output=True)
+        commands = {
+            'info': ['info', str(car_file)],
+            'settype': ['settype', str(car_file), 'Mode_8K'],
+            'delblob': ['delblob', str(car_file)],
+        }
+        results = {name: measure(argv, args.repeat) for name, argv in commands.items()}
+
+    failed = False
+    baseline = json.loads(args.baseline.read_text()) if args.baseline else {}
+    for name, result in results.items():
+        verdict = ''
+        if unwanted := [module for module in DEFERRED_MODULES if module in result['modules']]:
+            verdict += f' imports {", ".join(unwanted)}'
+        if name in baseline and result['import_us'] > baseline[name]['import_us'] * (1 + args.tolerance):
+            verdict += f' slower than baseline ({baseline[name]["import_us"] / 1000:.1f} ms)'
+        failed |= bool(verdict)
+        print(f'{name:10} {result["import_us"] / 1000:7.1f} ms{verdict or " OK"}')
+    if args.save:
+        args.save.write_text(json.dumps({name: {'import_us': result['import_us']} for name, result in results.items()}, indent=2))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,773 @@
+# Implementation of cart-tool.py. Kept importable so its bytecode is cached between runs.
+# Modules needed only by some of the subcommands are imported inside those subcommands to keep startup short.
+import argparse
+import os
+import sys
+
+import a8_cart
+from a8_cart import A8CARFile, ATCartridgeInfo
+
+def exception_handler(exception_type, exception, traceback, debug_hook=sys.excepthook):
+    has_trace = hasattr(sys, 'gettrace') and sys.gettrace() is not None
+    has_breakpoint = sys.breakpointhook.__module__ != "sys"
+    is_debug = has_trace or has_breakpoint
+    if is_debug:
+        debug_hook(exception_type, exception, traceback)
+    else:
+        # No debug
+        print (f'{os.path.basename(traceback.tb_frame.f_code.co_filename)}@{traceback.tb_lineno}: {exception_type.__name__}: {exception}')
+
+sys.excepthook = exception_handler
+
+
+def cmd_info(cart_file, **kwargs):
+    import filesize
+    with a8_cart.A8CARFile(cart_file, mapped=True) as cart:
+        print(f'''Validity check: {'✓ OK' if cart.is_valid else '✗ fail'}
+Cart type: {cart.header._cart_mode} → {cart.header._cart_mode.mCartDescription}
+Cart max ROM size: {cart.header._cart_mode.mCartSize:_} (0x{cart.header._cart_mode.mCartSize:04X}) <{filesize.naturalsize(cart.header._cart_mode.mCartSize, binary=True)}>
+ROM actual size: {len(cart.rom_data):_} (0x{len(cart.rom_data):04X}) <{filesize.naturalsize(len(cart.rom_data), binary=True)}>
+BLOB: {f'✓ {len(cart.blob):_} (0x{len(cart.blob):04X}) <{filesize.naturalsize(len(cart.blob), binary=True)}>' if len(cart.blob) else '✗ No BLOB'}''')
+
+
+def save_cart(cart: A8CARFile, cart_file_name):
+    a8_cart.save_atomic(cart, cart_file_name)
+
+
+def _report_stream(*file_names):
+    """Stream for messages, standard error when an output goes to standard output"""
+    return sys.stderr if a8_cart.STDIO in file_names else sys.stdout
+
+
+def _check_stdin(*inputs):
+    if sum(arg == a8_cart.STDIO or arg is sys.stdin.buffer for arg in inputs) > 1:
+        raise ValueError('Only one input can be read from standard input')
+
+
+def cmd_set_blob(cart_file, blob_file, **kwargs):
+    if cart_file == a8_cart.STDIO:
+        _check_stdin(cart_file, blob_file)
+        # Filter from standard input to standard output. The whole file is written anew, so its checksum is recomputed
+        with a8_cart.A8CARFile(cart_file, mapped=True) as cart:
+            cart.blob = a8_cart.read_all(blob_file) if blob_file else b''
+            save_cart(cart, cart_file)
+    else:
+        a8_cart.update_in_place(cart_file, blob=blob_file or b'')
+
+
+def cmd_delete_blob(cart_file, **kwargs):
+    cmd_set_blob(cart_file, None)
+
+
+def cmd_get_blob(cart_file, blob_file, **kwargs):
+    with a8_cart.A8CARFile(cart_file, mapped=True) as cart:
+        if cart.blob:
+            with a8_cart.open_output(blob_file) as f_out:
+                a8_cart.write_chunked(f_out, cart.blob)
+
+
+def cmd_get_rom(cart_file, rom_file, **kwargs):
+    with a8_cart.A8CARFile(cart_file, mapped=True) as cart:
+        if cart.rom_data:
+            with a8_cart.open_output(rom_file) as f_out:
+                a8_cart.write_chunked(f_out, cart.rom_data)
+
+
+def cmd_set_type(cart_file, cart_type: int, adjust_size: bool, **kwargs):
+    with a8_cart.A8CARFile(cart_file, mapped=True) as cart:
+        # Set on the stored header, the header property would sum the ROM even when only the mode field gets patched.
+        # The checksum is computed only if the file is written anew
+        cart._header.cart_mode = cart_type
+        cart_mode = cart._header.cart_mode
+        if cart_mode != cart_mode.Mode_Unknown or cart_mode != cart_mode.Mode_None:
+            if adjust_size and len(cart.rom_data) != cart_mode.mCartSize:
+                # truncate or extend with 0xFF, ROM size changes so the whole file is rewritten.
+                # Only the bytes kept are summed: before padding (the fill is accounted for by resize_rom), after truncation
+                if len(cart.rom_data) < cart_mode.mCartSize:
+                    cart.data_csum
+                cart.resize_rom(cart_mode.mCartSize)
+                save_cart(cart, cart_file)
+            elif cart_file == a8_cart.STDIO:
+                save_cart(cart, cart_file)
+            else:
+                cart.close()
+                a8_cart.update_in_place(cart_file, cart_mode=cart_type)
+        else:
+            ValueError(f'Cannot set caty type to {cart_type} - {cart_mode.mCartDescription}')
+
+
+def cmd_rom2car(rom_file, cart_file, cart_type: ATCartridgeInfo, **kwargs):
+    import filesize
+    report = _report_stream(cart_file)
+    cart = A8CARFile()
+    cart.rom_data = a8_cart.read_all(rom_file)
+    rom_length = len(cart.rom_data)
+    if rom_length:
+        if cart_type.is_virtual:
+            # Autodetect needed
+            candidates = a8_cart.detect_cart_modes(cart.rom_data)
+            print(f'Autodetecting:\n ROM size {filesize.naturalsize(rom_length, True)},\n all matching options: {", ".join(f"{candidate.mode.name} ({candidate.confidence:.0%})" for candidate in candidates)}', file=report)
+            if not candidates:
+                raise RuntimeError('Couldn\'t identify CART type based on ROM file')
+            cart_type = candidates[0].mode
+        cart.header.cart_mode = cart_type
+        save_cart(cart, cart_file)
+        print(f'Created CART with mode: "{cart.header.cart_mode.name}"', file=report)
+        if cart.header.cart_mode.mCartSize != rom_length:
+            print(f'ROM size mismatch for type "{cart.header.cart_mode.name}"! (ROM file size={rom_length:_}, Cart mode ROM size={cart.header.cart_mode.mCartSize:_})', file=report)
+    else:
+        raise ValueError('ROM file length is 0')
+
+
+def cmd_opt_list(output_format: str = 'HUMAN', **kwargs):
+    real_cartlist = a8_cart.REAL_MODES
+    if output_format.upper() == 'JSON':
+        import json
+        print(json.dumps(separators=(',', ':'), obj={item.name: {'mode': item.value, 'size': item.mCartSize, 'description': item.mCartDescription} for item in real_cartlist}))
+    else:
+        import filesize
+        for carttype in real_cartlist:
+            print(f'{carttype}={carttype.name} <{filesize.naturalsize(carttype.mCartSize, binary=True)}> "{carttype.mCartDescription}"')
+
+
+def _read_manifest(manifest) -> list[list[str]]:
+    import csv
+    import io
+    import json
+    text = manifest.read()
+    if os.path.splitext(manifest.name)[1].lower() == '.csv':
+        rows = csv.reader(io.StringIO(text))
+        return [[arg.strip() for arg in row] for row in rows if row and row[0].strip() and not row[0].lstrip().startswith('#')]
+    jobs = json.loads(text)
+    if not isinstance(jobs, list) or not all(isinstance(job, list) and job and all(isinstance(arg, str) for arg in job) for job in jobs):
+        raise ValueError('Manifest must be a JSON array of command lines, each a non-empty list of strings')
+    return jobs
+
+
+_job_parser = None
+
+
+def _run_job(argv: list[str], cwd: str = None) -> dict:
+    """Run one cart-tool command line in this process, capturing its output. Used by batch and serve workers"""
+    import contextlib
+    import io
+    import time
+    global _job_parser
+    if _job_parser is None:
+        # Built once per worker process
+        _job_parser = build_parser()
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    exit_code = 0
+    start = time.perf_counter()
+    args = None
+    try:
+        if cwd is not None:
+            os.chdir(cwd)
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            args = _job_parser.parse_args(argv)
+            # Checked after parsing, global options may precede the command
+            if args.command in ('batch', 'serve'):
+                raise ValueError(f'Nested {args.command} jobs are not supported')
+            run_command(args)
+    except SystemExit as e:
+        exit_code = e.code if isinstance(e.code, int) else int(bool(e.code))
+    except Exception as e:
+        exit_code = 1
+        stderr.write(f'{type(e).__name__}: {e}\n')
+    finally:
+        for arg in vars(args).values() if args else ():
+            if isinstance(arg, io.IOBase) and arg not in (sys.stdin, sys.stdout, sys.stdin.buffer, sys.stdout.buffer):
+                arg.close()
+    return {'args': argv, 'status': 'FAIL' if exit_code else 'OK', 'exit_code': exit_code, 'time': time.perf_counter() - start,
+            'stdout': stdout.getvalue(), 'stderr': stderr.getvalue()}
+
+
+def cmd_batch(manifest, jobs: int = None, output_format: str = 'HUMAN', **kwargs):
+    import concurrent.futures
+    import json
+    import time
+    job_list = _read_manifest(manifest)
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        results = []
+        for result in executor.map(_run_job, job_list, chunksize=max(1, len(job_list) // (8 * (jobs or os.cpu_count() or 1)))):
+            results.append(result)
+            if output_format != 'JSON':
+                print(f'{result["status"]:4} {result["time"]:8.3f}s  {" ".join(result["args"])}')
+                if result['status'] != 'OK' and (output := (result['stdout'] + result['stderr']).strip()):
+                    print(f'     {output}'.replace('\n', '\n     '))
+    elapsed = time.perf_counter() - start
+    failed = sum(result['status'] != 'OK' for result in results)
+    if output_format == 'JSON':
+        print(json.dumps(obj={'jobs': results, 'failed': failed, 'time': elapsed}, separators=(',', ':')))
+    else:
+        print(f'{len(results) - failed}/{len(results)} jobs OK in {elapsed:.3f}s')
+    if failed:
+        raise RuntimeError(f'{failed} of {len(results)} batch jobs failed')
+
+
+def _reset_worker_signals():
+    # Workers forked after the server installed its SIGTERM handler would inherit it. The server alone handles
+    # Ctrl+C (sent to the whole process group) and SIGTERM, and shuts the pool down
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def cmd_serve(socket_path: str = None, jobs: int = None, **kwargs):
+    import concurrent.futures
+    import json
+    import signal
+    import socket
+    import socketserver
+    import stat
+    import cart_tool_client
+    socket_path = socket_path or cart_tool_client.default_socket_path()
+    if os.path.exists(socket_path):
+        if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+            raise RuntimeError(f'{socket_path} exists and is not a socket')
+        # Refuse to take over a live server, remove a stale socket file
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(socket_path)
+            except OSError:
+                os.unlink(socket_path)
+            else:
+                raise RuntimeError(f'A server is already listening on {socket_path}')
+
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=_reset_worker_signals)
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                request = json.loads(self.rfile.readline())
+                result = executor.submit(_run_job, request['argv'], request.get('cwd')).result()
+            except Exception as e:
+                result = {'exit_code': 1, 'stdout': '', 'stderr': f'{type(e).__name__}: {e}\n'}
+            try:
+                for stream in ('stdout', 'stderr'):
+                    if result[stream]:
+                        self.wfile.write(json.dumps({stream: result[stream]}).encode() + b'\n')
+                self.wfile.write(json.dumps({'exit': result['exit_code']}).encode() + b'\n')
+            except (BrokenPipeError, ConnectionResetError):
+                # Client went away, nothing left to report to
+                pass
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    # Stop cleanly on SIGTERM as well as on Ctrl+C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    with executor, Server(socket_path, RequestHandler) as server:
+        print(f'Serving on {socket_path}', flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(socket_path)
+
+
+def cmd_store(store_command: str, store_dir: str, cart_files=(), name: str = None, cart_file: str = None, output_format: str = 'HUMAN', **kwargs):
+    import a8_cart_store
+    import filesize
+    store = a8_cart_store.BankStore(store_dir)
+    if store_command == 'add':
+        for file_name in cart_files:
+            entry = store.add(file_name)
+            print(f'{entry["name"]}: {len(entry["banks"])} banks, {entry["new_objects"]} new objects, {filesize.naturalsize(entry["new_bytes"], binary=True)} stored')
+    elif store_command == 'get':
+        store.get(name, cart_file or name)
+    else:
+        stats = store.stats()
+        if output_format == 'JSON':
+            import json
+            print(json.dumps(obj=stats, separators=(',', ':')))
+        else:
+            print(f'''Cartridges: {stats['carts']:_} <{filesize.naturalsize(stats['cart_bytes'], binary=True)}>
+Banks: {stats['banks']:_}
+Stored objects: {stats['objects']:_} <{filesize.naturalsize(stats['object_bytes'], binary=True)}>
+Deduplication ratio: {stats['ratio']:.2f}''')
+
+
+def cmd_index(directory: str, database: str, hashes: bool = False, jobs: int = None, **kwargs):
+    import a8_cart_index
+    with a8_cart_index.CartIndex(database) as index:
+        counts = index.update(directory, hashes=hashes, jobs=jobs)
+    print(f'{counts["files"]:_} CAR files: {counts["indexed"]:_} indexed, {counts["unchanged"]:_} unchanged, {counts["skipped"]:_} skipped (not CAR), {counts["removed"]:_} removed')
+
+
+def cmd_query(database: str, output_format: str = 'HUMAN', **filters):
+    import a8_cart_index
+    filters = {key: value for key, value in filters.items() if key in ('mode', 'system', 'banking', 'has_blob', 'min_size', 'max_size', 'csum', 'sha256', 'path')}
+    if not os.path.exists(database):
+        raise RuntimeError(f'No index database {database}, create it with the index command')
+    with a8_cart_index.CartIndex(database) as index:
+        records = index.query(**filters)
+    if output_format == 'JSON':
+        import json
+        print(json.dumps(obj=records, separators=(',', ':')))
+    else:
+        for record in records:
+            print(f'{record["mode_name"]:26} ROM {record["rom_size"]:>11_} BLOB {record["blob_size"]:>9_}  {record["path"]}')
+
+
+def cmd_mkpatch(old_cart_file: str, new_cart_file: str, patch_file: str, **kwargs):
+    import a8_cart_patch
+    import filesize
+    _check_stdin(old_cart_file, new_cart_file)
+    sizes = a8_cart_patch.make_patch(old_cart_file, new_cart_file, patch_file)
+    print(f'Patch size: {filesize.naturalsize(sizes["patch_size"], binary=True)} ({sizes["patch_size"] / sizes["target_size"]:.2%} of {filesize.naturalsize(sizes["target_size"], binary=True)})',
+          file=_report_stream(patch_file))
+
+
+def cmd_applypatch(old_cart_file: str, patch_file: str, new_cart_file: str, **kwargs):
+    import a8_cart_patch
+    _check_stdin(old_cart_file, patch_file)
+    a8_cart_patch.apply_patch(old_cart_file, patch_file, new_cart_file)
+
+
+def cmd_pack(cart_file: str, rom_files: list[str], cart_type: ATCartridgeInfo, compact: bool = False, reserve: int = 0, with_blob: bool = False, map_file: str = None, **kwargs):
+    import a8_cart_pack
+    bank = a8_cart.bank_size(cart_type)
+    if map_file == a8_cart.STDIO and cart_file == a8_cart.STDIO:
+        raise ValueError('<CAR file> and the map can\'t both go to standard output')
+    report = _report_stream(cart_file, map_file)
+    placements = a8_cart_pack.pack(rom_files, cart_type, cart_file, compact=compact, reserve=reserve, with_blob=with_blob)
+    for placement in sorted(placements, key=lambda placement: placement.bank):
+        print(f'bank {placement.bank:5}-{placement.bank + placement.banks - 1:<5} {placement.size:>11_}  {placement.file_name}', file=report)
+    used = sum(placement.banks for placement in placements)
+    print(f'{len(placements)} ROMs in {used + reserve}/{cart_type.mCartSize // bank} banks of {bank // 1024}K, mode "{cart_type.name}"', file=report)
+    if map_file:
+        import contextlib
+        import json
+        with contextlib.nullcontext(sys.stdout) if map_file == a8_cart.STDIO else open(map_file, 'w') as f_map:
+            json.dump([{'file': placement.file_name, 'size': placement.size, 'bank': placement.bank, 'banks': placement.banks, 'offset': placement.bank * bank}
+                       for placement in placements], f_map, indent=1)
+
+
+def cmd_compress(cart_file: str, compressed_file: str, codec: str = 'zlib', level: int = None, **kwargs):
+    import a8_cart_compress
+    import filesize
+    sizes = a8_cart_compress.compress(cart_file, compressed_file, codec=codec, level=level)
+    print(f'{filesize.naturalsize(sizes["size"], binary=True)} → {filesize.naturalsize(sizes["compressed_size"], binary=True)} ({sizes["compressed_size"] / sizes["size"]:.2%}), '
+          f'{sizes["stored_frames"]}/{sizes["frames"]} frames stored, codec {codec}', file=_report_stream(compressed_file))
+
+
+def cmd_decompress(compressed_file: str, cart_file: str, **kwargs):
+    import a8_cart_compress
+    a8_cart_compress.decompress(compressed_file, cart_file)
+
+
+def _bank_job(bank: a8_cart.Bank, hash_name: str, out_file: str) -> dict:
+    # Runs in a worker thread, hashing and writing release the GIL
+    import hashlib
+    import zlib
+    with bank.data as data:
+        digest = f'{zlib.crc32(data):08x}' if hash_name == 'crc32' else hashlib.new(hash_name, data).hexdigest()
+        if out_file:
+            with open(out_file, 'wb') as f_out:
+                f_out.write(data)
+    return {'bank': bank.number, 'offset': bank.offset, 'size': bank.size, 'window': f'${bank.window[0]:04X}-${bank.window[1] - 1:04X}', hash_name: digest, 'file': out_file}
+
+
+def cmd_banks(cart_file: str, bank_numbers: list[int] = None, output_dir: str = None, hash_name: str = 'sha256', jobs: int = None, output_format: str = 'HUMAN', **kwargs):
+    import concurrent.futures
+    with a8_cart.A8CARFile(cart_file, mapped=True) as cart:
+        mode = cart._header.cart_mode
+        size = a8_cart.bank_size(mode) or len(cart.rom_data) or 1
+        count = -(-len(cart.rom_data) // size)
+        banks = []
+        try:
+            # Only the selected banks are viewed, the rest of a mapped file is never read
+            for number in bank_numbers or range(count):
+                banks.append(cart.bank(number))
+            out_files = [None] * len(banks)
+            if output_dir:
+                os.makedirs(output_dir, exist_ok=True)
+                stem = os.path.splitext(os.path.basename(cart_file))[0]
+                out_files = [os.path.join(output_dir, f'{stem}.bank{bank.number:0{len(str(count - 1))}}.bin') for bank in banks]
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+                results = list(executor.map(_bank_job, banks, [hash_name] * len(banks), out_files))
+        finally:
+            # A view left alive would make closing the mapped file fail with BufferError, hiding the actual error
+            for bank in banks:
+                bank.data.release()
+    if output_format == 'JSON':
+        import json
+        print(json.dumps(obj={'mode': mode.name, 'bank_size': size, 'banks': results}, separators=(',', ':')))
+    else:
+        print(f'{count} banks of {size:_} bytes, mode "{mode.name}"')
+        for result in results:
+            print(f'bank {result["bank"]:5} offset 0x{result["offset"]:07X} {result["size"]:>9_} {result["window"]}  {result[hash_name]}{"  " + result["file"] if result["file"] else ""}')
+
+
+def _verify_job(path: str, checksum: bool) -> dict:
+    try:
+        if checksum:
+            # A worker sums many files, NumPy (if installed) pays off its import time
+            a8_cart._get_numpy()
+        size = os.path.getsize(path)
+        problems = a8_cart.verify_file(path, checksum=checksum)
+    except OSError as e:
+        size = 0
+        problems = [f'{type(e).__name__}: {e}']
+    return {'path': path, 'status': 'FAIL' if problems else 'OK', 'problems': problems, 'size': size}
+
+
+def cmd_verify(paths: list[str], fast: bool = False, jobs: int = None, verbose: bool = False, output_format: str = 'HUMAN', **kwargs):
+    import concurrent.futures
+    import time
+    import filesize
+    files = []
+    for path in paths:
+        files.extend(a8_cart.find_car_files(path) if os.path.isdir(path) else (path,))
+    start = time.perf_counter()
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        for result in executor.map(_verify_job, files, [not fast] * len(files), chunksize=max(1, len(files) // (8 * (jobs or os.cpu_count() or 1)))):
+            results.append(result)
+            if output_format != 'JSON' and (verbose or result['problems']):
+                print(f'{result["status"]:4} {result["path"]}{": " if result["problems"] else ""}{"; ".join(result["problems"])}')
+    elapsed = time.perf_counter() - start
+    failed = sum(bool(result['problems']) for result in results)
+    total = sum(result['size'] for result in results)
+    if output_format == 'JSON':
+        import json
+        print(json.dumps(obj={'files': results, 'failed': failed, 'time': elapsed, 'bytes': total}, separators=(',', ':')))
+    else:
+        throughput = '' if fast else f', {filesize.naturalsize(total, binary=True)} at {filesize.naturalsize(total / elapsed if elapsed else 0, binary=True)}/s'
+        print(f'{len(results) - failed}/{len(results)} files OK in {elapsed:.3f}s{throughput}')
+    if failed:
+        raise RuntimeError(f'{failed} of {len(results)} files failed verification')
+
+
+command_map = {
+    # info
+    'info': cmd_info,
+    # list
+    'list': cmd_opt_list,
+    # setblob
+    'setblob': cmd_set_blob,
+    'set': cmd_set_blob,
+    'addblob': cmd_set_blob,
+    'add': cmd_set_blob,
+    # delblob
+    'delblob': cmd_delete_blob,
+    'del': cmd_delete_blob,
+    'rm': cmd_delete_blob,
+    'erase': cmd_delete_blob,
+    # getblob
+    'getblob': cmd_get_blob,
+    'get': cmd_get_blob,
+    'extract': cmd_get_blob,
+    # getrom
+    'getrom': cmd_get_rom,
+    'rom': cmd_get_rom,
+    # settype
+    'settype': cmd_set_type,
+    # rom2car
+    'rom2car': cmd_rom2car,
+    'convert': cmd_rom2car,
+    'convertrom': cmd_rom2car,
+    # batch
+    'batch': cmd_batch,
+    # serve
+    'serve': cmd_serve,
+    # store
+    'store': cmd_store,
+    # index
+    'index': cmd_index,
+    # query
+    'query': cmd_query,
+    # mkpatch
+    'mkpatch': cmd_mkpatch,
+    'diff': cmd_mkpatch,
+    # applypatch
+    'applypatch': cmd_applypatch,
+    'patch': cmd_applypatch,
+    # pack
+    'pack': cmd_pack,
+    # verify
+    'verify': cmd_verify,
+    # banks
+    'banks': cmd_banks,
+    # compress
+    'compress': cmd_compress,
+    # decompress
+    'decompress': cmd_decompress,
+}
+
+
+class _SpanCollector(a8_cart.ProfileCollector):
+    """Collects start, duration and peak traced memory of the profiling spans"""
+
+    def __init__(self):
+        import time
+        self.spans = []
+        self._clock = time.perf_counter
+        self._origin = self._clock()
+        # [start, peak of the finished part] of the open spans
+        self._stack = []
+
+    def span_start(self, phase: str):
+        import tracemalloc
+        current, peak = tracemalloc.get_traced_memory()
+        if self._stack:
+            self._stack[-1][1] = max(self._stack[-1][1], peak)
+        self._stack.append([self._clock() - self._origin, current])
+        tracemalloc.reset_peak()
+
+    def span_end(self, phase: str, elapsed: float):
+        import tracemalloc
+        start, peak = self._stack.pop()
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        if self._stack:
+            self._stack[-1][1] = max(self._stack[-1][1], peak)
+        self.spans.append({'phase': phase, 'depth': len(self._stack), 'start': round(start, 6), 'time': round(elapsed, 6), 'peak': peak})
+
+
+def run_command(args):
+    """Run the subcommand of parsed *args*. With --profile its spans are reported as JSON on stderr, --profile-dump adds a cProfile dump"""
+    command = command_map.get(args.command)
+    if command is None:
+        raise RuntimeError(f'Unable to execute command "{args.command}". Internal error.')
+    if not (args.profile or args.profile_dump):
+        command(**vars(args))
+        return
+    import json
+    import tracemalloc
+    collector = _SpanCollector()
+    profiler = None
+    if args.profile_dump:
+        import cProfile
+        profiler = cProfile.Profile()
+    tracemalloc.start()
+    a8_cart.add_profile_collector(collector)
+    try:
+        with a8_cart.ProfileSpan(args.command):
+            if profiler:
+                profiler.runcall(command, **vars(args))
+            else:
+                command(**vars(args))
+    finally:
+        a8_cart.remove_profile_collector(collector)
+        tracemalloc.stop()
+        if profiler:
+            profiler.dump_stats(args.profile_dump)
+        print(json.dumps(obj={'command': args.command, 'spans': sorted(collector.spans, key=lambda span: span['start'])}, separators=(',', ':')), file=sys.stderr)
+
+
+def param_to_cart_type(val):
+    ret_val = a8_cart.find_mode(val)
+    if ret_val.is_virtual:
+        raise ValueError('Virtual cart type')
+    return ret_val
+
+
+def _add_info_args(sub_cmd):
+    sub_cmd.add_argument('cart_file', type=argparse.FileType('rb'), metavar='<CAR file>', help='Input file. The file is not modified.')
+
+
+def _add_list_args(sub_cmd):
+    sub_cmd.add_argument('-f', '--format', dest='output_format', type=str, default='HUMAN', help='Define output format. Default is human readable format. Specify -f JSON for JSON format.')
+
+
+def _add_set_blob_args(sub_cmd):
+    sub_cmd.add_argument('cart_file', type=str, metavar='<CAR file>', help='Input/output file. A BLOB is added in place, an existing BLOB is replaced by rewriting the file atomically.')
+    sub_cmd.add_argument('blob_file', type=argparse.FileType('rb'), metavar='<BLOB file>', help='Input file. The file is not modified.')
+
+
+def _add_delete_blob_args(sub_cmd):
+    sub_cmd.add_argument('cart_file', type=str, metavar='<CAR file>', help='Input/output file. File content updated in place, or replaced atomically when the ROM size changes.')
+
+
+def _add_get_blob_args(sub_cmd):
+    sub_cmd.add_argument('cart_file', type=argparse.FileType('rb'), metavar='<CAR file>', help='Input file. The file is not modified.')
+    sub_cmd.add_argument('blob_file', type=str, metavar='<BLOB file>', help='Generated file. If file exists, it will be overwritten without backup.')
+
+
+def _add_get_rom_args(sub_cmd):
+    sub_cmd.add_argument('cart_file', type=argparse.FileType('rb'), metavar='<CAR file>', help='Input file. The file is not modified.')
+    sub_cmd.add_argument('rom_file', type=str, metavar='<ROM file>', help='Generated file. If file exists, it will be overwritten without backup.')
+
+
+def _add_set_type_args(sub_cmd):
+    sub_cmd.add_argument('cart_file', type=str, metavar='<CAR file>', help='Input/output file. File content updated in place, or replaced atomically when the ROM size changes.')
+    sub_cmd.add_argument('cart_type', type=param_to_cart_type, help='New type identifier. To list all known types, run the command with --list')
+    sub_cmd.add_argument('-a', '--adjust-size', action='store_true', help='If the new CART type is bigger or smaller, the ROM content will be extended (0xFF) or truncated.')
+
+
+def _add_rom2car_args(sub_cmd):
+    sub_cmd.add_argument('rom_file', type=argparse.FileType('rb'), metavar='<ROM file>', help='Source (cart-type guess is based on the size and the cartridge trailers)')
+    sub_cmd.add_argument('cart_file', type=str, metavar='<CAR file>', help='Generated file. If file exists, it will be overwritten without backup.')
+    sub_cmd.add_argument('-t', '--cart-type', default=ATCartridgeInfo.Mode_Unknown, type=param_to_cart_type, help='If omitted, the cart-type will be guessed')
+
+
+def _add_batch_args(sub_cmd):
+    sub_cmd.add_argument('manifest', type=argparse.FileType('r'), metavar='<manifest>', help='JSON array of command lines (each a list of arguments) or CSV file with one command line per row.')
+    sub_cmd.add_argument('-j', '--jobs', type=int, default=None, help='Number of worker processes. Default is the number of CPUs.')
+    sub_cmd.add_argument('-f', '--format', dest='output_format', type=str.upper, default='HUMAN', choices=('HUMAN', 'JSON'), help='Report format. Default is human readable format.')
+
+
+def _add_serve_args(sub_cmd):
+    sub_cmd.add_argument('-s', '--socket', dest='socket_path', type=str, default=None, help='Unix socket path. Default is $CART_TOOL_SOCKET or cart-tool-<uid>.sock in $XDG_RUNTIME_DIR (or /tmp).')
+    sub_cmd.add_argument('-j', '--jobs', type=int, default=None, help='Number of worker processes. Default is the number of CPUs.')
+
+
+def _add_store_args(sub_cmd):
+    actions = sub_cmd.add_subparsers(dest='store_command', required=True)
+    add = actions.add_parser('add', help='Add CAR files to the store. A cartridge already stored under the same name is replaced.')
+    add.add_argument('store_dir', type=str, metavar='<store>', help='Store directory. Created if missing.')
+    add.add_argument('cart_files', type=str, nargs='+', metavar='<CAR file>', help='Input files, stored under their file names. The files are not modified.')
+    get = actions.add_parser('get', help='Reassemble a CAR file from the store')
+    get.add_argument('store_dir', type=str, metavar='<store>', help='Store directory')
+    get.add_argument('name', type=str, metavar='<name>', help='Name of the cartridge in the store')
+    get.add_argument('cart_file', type=str, nargs='?', metavar='<CAR file>', help='Generated file, default is <name> in the current directory. If file exists, it will be overwritten without backup.')
+    stats = actions.add_parser('stats', help='Show cartridge count, stored size and deduplication ratio of the store')
+    stats.add_argument('store_dir', type=str, metavar='<store>', help='Store directory')
+    stats.add_argument('-f', '--format', dest='output_format', type=str.upper, default='HUMAN', choices=('HUMAN', 'JSON'), help='Output format. Default is human readable format.')
+
+
+def _add_database_arg(sub_cmd):
+    sub_cmd.add_argument('-d', '--database', type=str, default='cart-index.sqlite', help='Index database file. Default is cart-index.sqlite in the current directory.')
+
+
+def _add_index_args(sub_cmd):
+    sub_cmd.add_argument('directory', type=str, metavar='<directory>', help='Directory searched recursively for .car files. The files are not modified.')
+    _add_database_arg(sub_cmd)
+    sub_cmd.add_argument('--hashes', action='store_true', help='Also record SHA-256 of the files and of their ROM. Reads the whole files instead of the headers only.')
+    sub_cmd.add_argument('-j', '--jobs', type=int, default=None, help='Number of files read in parallel. Default depends on the number of CPUs.')
+
+
+def _system_name(val):
+    names = {name.lower(): name for name in a8_cart.SystemType.__members__}
+    try:
+        return names.get(val.lower()) or names[f'ktype{val.lower()}']
+    except KeyError:
+        raise ValueError(f'Unknown system {val}') from None
+
+
+def _banking_name(val):
+    names = {name.lower(): name for name in a8_cart.BankingType.__members__}
+    try:
+        return names.get(val.lower()) or names[f'kbank{val.lower()}']
+    except KeyError:
+        raise ValueError(f'Unknown banking type {val}') from None
+
+
+def _add_query_args(sub_cmd):
+    _add_database_arg(sub_cmd)
+    sub_cmd.add_argument('-t', '--cart-type', dest='mode', metavar='CART_TYPE', type=param_to_cart_type, help='Cart type identifier (number or name)')
+    sub_cmd.add_argument('-s', '--system', type=_system_name, help='System type, 800 or 5200 (or kType800, kType5200)')
+    sub_cmd.add_argument('-b', '--banking', type=_banking_name, help='Banking type, e.g. Data or kBankData')
+    blob = sub_cmd.add_mutually_exclusive_group()
+    blob.add_argument('--blob', dest='has_blob', action='store_const', const=True, help='Only CAR files with BLOB')
+    blob.add_argument('--no-blob', dest='has_blob', action='store_const', const=False, help='Only CAR files without BLOB')
+    sub_cmd.add_argument('--min-size', type=lambda val: int(val, 0), help='Minimum ROM size in bytes')
+    sub_cmd.add_argument('--max-size', type=lambda val: int(val, 0), help='Maximum ROM size in bytes')
+    sub_cmd.add_argument('--csum', type=lambda val: int(val, 0), help='Header checksum')
+    sub_cmd.add_argument('--sha256', type=str.lower, help='SHA-256 of the whole file (needs an index built with --hashes)')
+    sub_cmd.add_argument('-p', '--path', type=str, help='Glob pattern of the absolute file path, e.g. "*/5200/*"')
+    sub_cmd.add_argument('-f', '--format', dest='output_format', type=str.upper, default='HUMAN', choices=('HUMAN', 'JSON'), help='Output format. Default is human readable format.')
+
+
+def _add_mkpatch_args(sub_cmd):
+    sub_cmd.add_argument('old_cart_file', type=str, metavar='<old CAR file>', help='Source of the patch. The file is not modified.')
+    sub_cmd.add_argument('new_cart_file', type=str, metavar='<new CAR file>', help='Result of applying the patch. The file is not modified.')
+    sub_cmd.add_argument('patch_file', type=str, metavar='<patch file>', help='Generated file. If file exists, it will be overwritten without backup.')
+
+
+def _add_applypatch_args(sub_cmd):
+    sub_cmd.add_argument('old_cart_file', type=str, metavar='<old CAR file>', help='CAR file the patch was made for. The file is not modified.')
+    sub_cmd.add_argument('patch_file', type=str, metavar='<patch file>', help='Patch made by mkpatch')
+    sub_cmd.add_argument('new_cart_file', type=str, metavar='<new CAR file>', help='Generated file, replaced only if the result is verified. If file exists, it will be overwritten without backup.')
+
+
+def _add_pack_args(sub_cmd):
+    sub_cmd.add_argument('cart_file', type=str, metavar='<CAR file>', help='Generated file. If file exists, it will be overwritten without backup.')
+    sub_cmd.add_argument('rom_files', type=str, nargs='+', metavar='<ROM file>', help='ROMs to pack. The files are not modified.')
+    sub_cmd.add_argument('-t', '--cart-type', required=True, type=param_to_cart_type, help='Banked cart type of the image, e.g. Mode_MegaCart_1M or Mode_TheCart_128M')
+    sub_cmd.add_argument('--compact', action='store_true', help='Give each ROM just the banks it needs. Default is a power of two banks, aligned to the slot size.')
+    sub_cmd.add_argument('--reserve', type=int, default=0, help='Number of banks kept free at the start of the image, e.g. for a menu')
+    sub_cmd.add_argument('--blob', dest='with_blob', action='store_true', help='Store the placement table as BLOB of the CAR file')
+    sub_cmd.add_argument('-m', '--map', dest='map_file', type=str, help='Write the placement table as JSON to this file')
+
+
+def _add_banks_args(sub_cmd):
+    sub_cmd.add_argument('cart_file', type=str, metavar='<CAR file>', help='The file is not modified')
+    sub_cmd.add_argument('-b', '--bank', dest='bank_numbers', type=int, action='append', help='Bank number, negative numbers count from the last bank. Can be repeated. Default is all banks.')
+    sub_cmd.add_argument('-o', '--output-dir', type=str, default=None, help='Write each bank into a file <CAR file name>.bank<number>.bin in this directory. If files exist, they will be overwritten without backup.')
+    sub_cmd.add_argument('--hash', dest='hash_name', type=str.lower, default='sha256', choices=('sha256', 'sha1', 'md5', 'crc32'), help='Hash listed per bank. Default is sha256.')
+    sub_cmd.add_argument('-j', '--jobs', type=int, default=None, help='Number of banks hashed and written at once. Default depends on the number of CPUs.')
+    sub_cmd.add_argument('-f', '--format', dest='output_format', type=str.upper, default='HUMAN', choices=('HUMAN', 'JSON'), help='Output format. Default is human readable format.')
+
+
+def _add_compress_args(sub_cmd):
+    sub_cmd.add_argument('cart_file', type=str, metavar='<CAR file>', help='File to compress. The file is not modified.')
+    sub_cmd.add_argument('compressed_file', type=str, metavar='<compressed file>', help='Generated file. If file exists, it will be overwritten without backup.')
+    sub_cmd.add_argument('-c', '--codec', type=str.lower, default='zlib', choices=('none', 'zlib', 'lzma', 'zstd'), help='Compression of the frames. zstd needs the zstandard package. Default is zlib.')
+    sub_cmd.add_argument('-l', '--level', type=int, default=None, help='Compression level of the codec. Default is the strongest practical level of the codec.')
+
+
+def _add_decompress_args(sub_cmd):
+    sub_cmd.add_argument('compressed_file', type=str, metavar='<compressed file>', help='File made by compress. The file is not modified.')
+    sub_cmd.add_argument('cart_file', type=str, metavar='<CAR file>', help='Generated file, identical to the compressed one. If file exists, it will be overwritten without backup.')
+
+
+def _add_verify_args(sub_cmd):
+    sub_cmd.add_argument('paths', type=str, nargs='+', metavar='<path>', help='CAR files and/or directories searched recursively for .car files. The files are not modified.')
+    sub_cmd.add_argument('--fast', action='store_true', help='Check the headers against the file sizes only, skip the ROM checksum')
+    sub_cmd.add_argument('-j', '--jobs', type=int, default=None, help='Number of worker processes. Default is the number of CPUs.')
+    sub_cmd.add_argument('-v', '--verbose', action='store_true', help='List the files that passed too, not only the failed ones')
+    sub_cmd.add_argument('-f', '--format', dest='output_format', type=str.upper, default='HUMAN', choices=('HUMAN', 'JSON'), help='Report format. Default is human readable format.')
+
+
+# name: (aliases, help, argument registration)
+subcommands = {
+    'info': ((), 'Get <CAR file> information based on header', _add_info_args),
+    'list': ((), 'List available CART mode identifiers', _add_list_args),
+    'setblob': (('set', 'addblob', 'add'), 'Set  <CAR file> blob to bytes from <BLOB file>', _add_set_blob_args),
+    'delblob': (('del', 'rm', 'erase'), 'Eliminate BLOB from <CAR file>', _add_delete_blob_args),
+    'getblob': (('get', 'extract'), 'Extract BLOB from <CAR file> to <BLOB file>', _add_get_blob_args),
+    'getrom': (('rom',), 'Extract RAW ROM content from <CAR file> to <ROM file>', _add_get_rom_args),
+    'settype': ((), 'Override cart type in <CAR file>', _add_set_type_args),
+    'rom2car': (('convert', 'convertrom'), 'Convert RAW <ROM file> to <CAR file>', _add_rom2car_args),
+    'batch': ((), 'Run the commands listed in <manifest> across a pool of worker processes', _add_batch_args),
+    'serve': ((), 'Keep cart-tool loaded and run commands forwarded over a Unix socket', _add_serve_args),
+    'store': ((), 'Keep CAR files in a deduplicating bank store (add, get, stats)', _add_store_args),
+    'index': ((), 'Record the headers of all CAR files below <directory> in an SQLite database', _add_index_args),
+    'query': ((), 'List the CAR files of the index database matching all given filters', _add_query_args),
+    'mkpatch': (('diff',), 'Make a binary delta <patch file> turning <old CAR file> into <new CAR file>', _add_mkpatch_args),
+    'applypatch': (('patch',), 'Apply <patch file> to <old CAR file> giving <new CAR file>', _add_applypatch_args),
+    'pack': ((), 'Pack many <ROM file>s into the banks of a large multicart <CAR file>', _add_pack_args),
+    'verify': ((), 'Check header, sizes and checksum of CAR files, spread over worker processes', _add_verify_args),
+    'banks': ((), 'List the ROM banks of <CAR file> with hashes, or extract them into separate files', _add_banks_args),
+    'compress': ((), 'Compress <CAR file> bank by bank into <compressed file>, which all commands reading CAR files accept', _add_compress_args),
+    'decompress': ((), 'Restore the <CAR file> of <compressed file>', _add_decompress_args),
+}
+
+
+def build_parser(command: str = None):
+    """Build the command line parser. If *command* names a subcommand (or alias), only that subparser is registered"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profile', action='store_true', help='Report time and peak memory of each phase of the command as JSON on stderr')
+    parser.add_argument('--profile-dump', type=str, metavar='FILE', help='Also write cProfile statistics of the command to FILE (implies --profile)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    known = command in command_map
+    for name, (aliases, help_text, add_args) in subcommands.items():
+        if not known or command == name or command in aliases:
+            add_args(subparsers.add_parser(name, aliases=aliases, help=help_text))
+    return parser
+
+
+def main(argv: list[str] = None):
+    argv = sys.argv[1:] if argv is None else argv
+    # Subcommand is the first known command name, global options may precede it
+    args = build_parser(next((arg for arg in argv if arg in command_map), None)).parse_args(argv)
+    run_command(args)
+
+
+if __name__ == '__main__':
+    main()
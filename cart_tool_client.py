@@ -0,0 +1,62 @@
+# Thin client of the cart-tool server (cart-tool.py serve).
+# Forwards the command line to the server when one is configured, otherwise runs the command locally.
+# Only os and sys are imported up front, so forwarding a command skips loading a8_cart entirely.
+import os
+import sys
+
+SOCKET_ENV = 'CART_TOOL_SOCKET'
+
+# Commands that never get forwarded
+LOCAL_COMMANDS = ('serve', 'batch', '-h', '--help')
+
+
+def default_socket_path() -> str:
+    if path := os.environ.get(SOCKET_ENV):
+        return path
+    return os.path.join(os.environ.get('XDG_RUNTIME_DIR') or '/tmp', f'cart-tool-{os.getuid()}.sock')
+
+
+def forward(argv: list[str], socket_path: str):
+    """Run *argv* on the server listening on *socket_path*, copying its output to stdout/stderr.
+    Returns the exit status of the command, or None if no server is reachable"""
+    import json
+    import socket
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    except AttributeError:
+        # No Unix sockets on this platform
+        return None
+    with sock:
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            return None
+        with sock.makefile('rwb') as stream:
+            stream.write(json.dumps({'argv': argv, 'cwd': os.getcwd()}).encode() + b'\n')
+            stream.flush()
+            for line in stream:
+                message = json.loads(line)
+                if 'stdout' in message:
+                    sys.stdout.write(message['stdout'])
+                if 'stderr' in message:
+                    sys.stderr.write(message['stderr'])
+                if 'exit' in message:
+                    sys.stdout.flush()
+                    return message['exit']
+    raise ConnectionError(f'Server on {socket_path} closed the connection before the command finished')
+
+
+def main():
+    argv = sys.argv[1:]
+    socket_path = os.environ.get(SOCKET_ENV)
+    if argv[:1] == ['--server']:
+        if len(argv) < 2:
+            sys.exit('--server needs a socket path')
+        socket_path, argv = argv[1], argv[2:]
+    # '-' means this process' own stdin/stdout, which the server can't reach
+    if socket_path and argv and not any(arg in LOCAL_COMMANDS for arg in argv) and '-' not in argv:
+        exit_code = forward(argv, socket_path)
+        if exit_code is not None:
+            sys.exit(exit_code)
+    from cart_tool import main as local_main
+    local_main(argv)
@@ -1,6 +1,10 @@
 #Script to generate MONO LCD raster images
 import argparse
+import glob
+import os
+import re
 import sys
+import time
 
 from PIL.Image import Dither
 
@@ -12,6 +16,95 @@ except ImportError:
 
 import pil_lcd_raster
 
+# Output format → (PIL save format, file name extension)
+OUTPUT_FORMATS = {
+    'BIN': ('rawlcdbin', '.rawlcd.bin'),
+    'C': ('rawlcdC', '.rawlcd.c'),
+}
+
+
+def convert_image(infile, outfile, varname='RAW_LCD_image', def_x=0, def_y=0, inverse=False, dither=True, auto_resize=True, output_format='BIN', hex_values=False, show=False):
+    """Convert image *infile* (file name or binary stream) to MONO LCD raster *outfile* (file name or binary stream)"""
+    im = Image.open(infile)
+    if auto_resize:
+        im.thumbnail((128,64))
+    if im.mode != '1':
+        im = im.convert('1', dither=Dither.FLOYDSTEINBERG if dither else Dither.NONE)
+    im.info['varname'] = varname
+    im.info['def_x'] = def_x
+    im.info['def_y'] = def_y
+    im.info['inverse'] = inverse
+    im.info['c_hex'] = hex_values
+    if show:
+        im.show()
+    # save an .lcd image
+    im.save(outfile, OUTPUT_FORMATS[output_format][0])
+    return im.size
+
+
+def _convert_job(infile, outfile, options):
+    start = time.perf_counter()
+    try:
+        size = convert_image(infile, outfile, **options)
+    except Exception as e:
+        return {'infile': infile, 'outfile': outfile, 'status': f'{type(e).__name__}: {e}', 'time': time.perf_counter() - start}
+    return {'infile': infile, 'outfile': outfile, 'status': 'OK', 'width': size[0], 'height': size[1],
+            'in_size': os.path.getsize(infile), 'out_size': os.path.getsize(outfile), 'time': time.perf_counter() - start}
+
+
+def _batch_inputs(patterns):
+    """Expand directories and glob patterns into a sorted list of image files"""
+    files = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            files.update(entry.path for entry in os.scandir(pattern) if entry.is_file())
+        else:
+            files.update(path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+    return sorted(files)
+
+
+def _c_identifier(name):
+    name = re.sub(r'\W', '_', name)
+    return f'_{name}' if name[:1].isdigit() else name
+
+
+def run_batch(patterns, outdir, jobs=None, summary=None, **options):
+    import concurrent.futures
+    import json
+    infiles = _batch_inputs(patterns)
+    extension = OUTPUT_FORMATS[options['output_format']][1]
+    outfiles = {}  # output file → input files written to it
+    for infile in infiles:
+        stem = os.path.splitext(os.path.basename(infile))[0]
+        outfiles.setdefault(os.path.join(outdir, stem + extension), []).append(infile)
+    clashes = [f'{outfile} ← {", ".join(sources)}' for outfile, sources in outfiles.items() if len(sources) > 1]
+    if clashes:
+        raise ValueError('Input files with the same name would overwrite each other: ' + '; '.join(clashes))
+    os.makedirs(outdir, exist_ok=True)
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = []
+        for outfile, (infile, ) in outfiles.items():
+            # Each image gets its own C variable, named after the file
+            job_options = dict(options, varname=_c_identifier(os.path.basename(outfile)[:-len(extension)]))
+            futures.append(executor.submit(_convert_job, infile, outfile, job_options))
+        results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+    failed = 0
+    for result in results:
+        if result['status'] == 'OK':
+            print(f'{result["time"] * 1000:8.1f}ms {result["in_size"]:>9_} → {result["out_size"]:>7_} B {result["width"]:>4}×{result["height"]:<3} {result["outfile"]}', file=sys.stderr)
+        else:
+            failed += 1
+            print(f'{result["time"] * 1000:8.1f}ms FAILED {result["infile"]}: {result["status"]}', file=sys.stderr)
+    total_out = sum(result.get('out_size', 0) for result in results)
+    print(f'{len(results) - failed}/{len(results)} images converted in {elapsed:.3f}s, {total_out:_} bytes written', file=sys.stderr)
+    if summary:
+        with open(summary, 'w') as f_summary:
+            json.dump({'images': results, 'failed': failed, 'time': elapsed, 'out_size': total_out}, f_summary, indent=1)
+    return failed
+
+
 def main():
     parser = argparse.ArgumentParser(description='Generate MONO LCD raster images')
     parser.add_argument('-i', '--infile', type=argparse.FileType('rb'), default='-', help='Input file')
@@ -22,20 +115,25 @@ def main():
     parser.add_argument('--no_dither', dest='dither', action='store_false', help='Convert non B&W image with 50% luminescence cut')
     parser.add_argument('--no_resize', dest='auto_resize', action='store_false', help='Disable resizing of images to fit OLED display 128×64')
     parser.add_argument('-o', '--outfile', type=argparse.FileType('wb'), default='-', help='Output file')
+    parser.add_argument('-f', '--format', dest='output_format', type=str.upper, default='BIN', choices=OUTPUT_FORMATS, help='Output format: BIN raw binary or C source code')
+    parser.add_argument('--hex', dest='hex_values', action='store_true', help='Write C array values in hexadecimal')
+    parser.add_argument('--show', action='store_true', help='Open the converted image in a viewer')
+    batch = parser.add_argument_group('batch mode', 'Convert many images in parallel. Variable names are derived from the file names, no viewer is opened.')
+    batch.add_argument('-b', '--batch', nargs='+', metavar='INPUT', help='Input directories and/or glob patterns (e.g. "icons/**/*.png")')
+    batch.add_argument('-d', '--outdir', type=str, default='.', help='Output directory of batch mode')
+    batch.add_argument('-j', '--jobs', type=int, default=None, help='Number of worker processes. Default is the number of CPUs.')
+    batch.add_argument('--summary', type=str, help='Write sizes and timings of the batch as JSON to this file')
     args = parser.parse_args()
-    # open an image
-    im = Image.open(args.infile)
-    if args.auto_resize:
-        im.thumbnail((128,64))
-    if im.mode != '1':
-        im = im.convert('1', dither=Dither.FLOYDSTEINBERG if args.dither else Dither.NONE)
-    im.info['varname'] = args.varname
-    im.info['def_x'] = args.defX
-    im.info['def_y'] = args.defY
-    im.info['inverse'] = args.inverse
-    im.show()
-    # save an .lcd image
-    im.save(args.outfile, 'rawlcdbin')
+    options = dict(def_x=args.defX, def_y=args.defY, inverse=args.inverse, dither=args.dither, auto_resize=args.auto_resize, output_format=args.output_format, hex_values=args.hex_values)
+    if args.batch:
+        try:
+            failed = run_batch(args.batch, args.outdir, jobs=args.jobs, summary=args.summary, **options)
+        except ValueError as e:
+            parser.error(str(e))
+        if failed:
+            sys.exit(1)
+    else:
+        convert_image(args.infile, args.outfile, varname=args.varname, show=args.show, **options)
 
 if __name__ == '__main__':
     main()
@@ -1,7 +1,6 @@
 import math
 import os
 import struct
-import textwrap
 
 from PIL import Image, ImageFile
 
@@ -19,18 +18,106 @@ class LCDRasterImageFile(ImageFile.ImageFile):
     format_description = 'RAW format for mono OLED or RGB LCD'
 
 
+# Pixel is set if luminance >= 128 (modes '1', 'L')
+_LUMA_THRESHOLD = bytes(0 if v < 128 else 1 for v in range(256))
+
+_numpy = None
+
+
+def _get_numpy():
+    """NumPy module if installed, imported on first use only"""
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy
+
+
+def _raw_pixels(im, rawmode):
+    """Raw pixel data of core image *im* in *rawmode*, rows top to bottom"""
+    encoder = Image._getencoder(im.mode, 'raw', rawmode)
+    encoder.setimage(im, (0, 0) + im.size)
+    chunks = []
+    while True:
+        l, s, d = encoder.encode(ImageFile.MAXBLOCK)
+        chunks.append(d[:l] if l < len(d) else d)
+        if s:
+            break
+    if s < 0:
+        raise OSError(f"encoder error {s} when reading image data")
+    return b''.join(chunks)
+
+
+def _pixel_bits(im):
+    """One byte per pixel, 1 if the pixel is set, row by row"""
+    if im.mode in ('1', 'L'):
+        return _raw_pixels(im, 'L').translate(_LUMA_THRESHOLD)
+    raw = _raw_pixels(im, 'RGBA')
+    # (R + G) * A / 255 >= 3 * 128, same rule as the per pixel encoder (blue is not taken into account)
+    return bytes((r + g) * a >= 3 * 128 * 255 for r, g, a in zip(raw[0::4], raw[1::4], raw[3::4]))
+
+
+def _pack_pages(im):
+    """Pack *im* into LCD pages: 8 rows per page, one byte per column, bit 0 = top row of the page"""
+    w, h = im.size
+    np = _get_numpy()
+    if np:
+        if im.mode in ('1', 'L'):
+            pixels = np.frombuffer(_raw_pixels(im, 'L'), dtype=np.uint8).reshape(h, w) >= 128
+        else:
+            rgba = np.frombuffer(_raw_pixels(im, 'RGBA'), dtype=np.uint8).reshape(h, w, 4).astype(np.uint32)
+            pixels = (rgba[..., 0] + rgba[..., 1]) * rgba[..., 3] >= 3 * 128 * 255
+        pages = np.zeros(((h + 7) // 8 * 8, w), dtype=np.uint8)
+        pages[:h] = pixels
+        return np.packbits(pages.reshape(-1, 8, w), axis=1, bitorder='little').tobytes()
+    bits = _pixel_bits(im)
+    packed = bytearray()
+    for page_y in range(0, h, 8):
+        # Rows of 0/1 bytes as little endian integers: shifting by the row index within the page moves each
+        # pixel to its bit position without carrying into the neighbour column, OR-ing builds the page bytes
+        page = 0
+        for row in range(min(8, h - page_y)):
+            y = page_y + row
+            page |= int.from_bytes(bits[y * w:(y + 1) * w], 'little') << row
+        packed += page.to_bytes(w, 'little')
+    return bytes(packed)
+
+
 class LCDRasterEncoder(ImageFile.PyEncoder):
     """
     Encoder for RASTER image files
     """
 
+    # Modes encoded from the raw image data in whole rows, other modes go pixel by pixel
+    BULK_MODES = ('1', 'L', 'RGB', 'RGBA')
+
     def __init__(self, mode, *args):
         super().__init__(mode, args)
         self.x = 0
         self.y = 0
         self.eof = False
+        self._packed = None
+        self._offset = 0
 
     def encode(self, bufsize):
+        if self.im.mode in self.BULK_MODES:
+            return self._encode_bulk(bufsize)
+        return self._encode_pixels(bufsize)
+
+    def _encode_bulk(self, bufsize):
+        if self._packed is None:
+            w, h = self.im.size
+            # As many bytes as the per pixel encoder produces: one per 8 pixels
+            self._packed = _pack_pages(self.im)[:math.ceil(w * h / 8)]
+        chunk = self._packed[self._offset:self._offset + bufsize]
+        self._offset += len(chunk)
+        self.eof = self._offset >= len(self._packed)
+        return len(chunk), 1 if self.eof else 0, chunk
+
+    def _encode_pixels(self, bufsize):
         buffer = bytearray(bufsize)
         i = 0
         w = self.im.size[0]
@@ -69,6 +156,34 @@ class LCDRasterEncoder(ImageFile.PyEncoder):
         del self.x
         del self.y
         del self.eof
+        self._packed = None
+
+
+class CArrayWriter:
+    """
+    Streams bytes to binary file *fp* as C array initializer rows of *row_len* values.
+    Rows continue across write() calls, call close() to flush the last, partial row.
+    """
+
+    def __init__(self, fp, row_len=16, hex_values=False):
+        self.fp = fp
+        self.row_len = row_len
+        self.value_format = b'0x%02X,' if hex_values else b'%d,'
+        # Formatting whole rows at once with bytes % is several times faster than per value str() and join
+        self.row_format = b' '.join([self.value_format] * row_len) + os.linesep.encode()
+        self._pending = b''
+
+    def write(self, data):
+        data = self._pending + bytes(data)
+        full = len(data) - len(data) % self.row_len
+        if full:
+            self.fp.write(self.row_format * (full // self.row_len) % tuple(data[:full]))
+        self._pending = data[full:]
+
+    def close(self):
+        if self._pending:
+            self.fp.write(b' '.join([self.value_format] * len(self._pending)) % tuple(self._pending) + os.linesep.encode())
+            self._pending = b''
 
 
 def _save(im, fp, filename, save_all=False):
@@ -92,15 +207,14 @@ def _save(im, fp, filename, save_all=False):
     rsrc_len = 9
     try:
         encoder.setimage(im.im, (0, 0) + im.size)
-        wrapper = textwrap.TextWrapper()
+        writer = CArrayWriter(fp, im.info.get('c_row_len', 16), im.info.get('c_hex', False))
         while True:
             l, s, d = encoder.encode(bufsize)
             rsrc_len += l
-            vals = [str(by) for by in d[:l]]
-            vallist = ', '.join(vals)
-            fp.write(wrapper.fill(vallist).encode())
+            writer.write(d[:l])
             if s:
                 break
+        writer.close()
         if s < 0:
             raise OSError(f"encoder error {s} when writing image file")
     finally: